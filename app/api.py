@@ -8,16 +8,19 @@ Description: Enhanced Flask-based REST API with bidirectional communication
              for UPS monitor clients.
 """
 
-import configparser
+import hmac
 import os
 import subprocess
 import json
+import logging
 import sys
-from datetime import datetime
-from flask import Flask, jsonify, request, abort
+import threading
+import time
+from flask import Flask, Response, jsonify, request, abort
 
 # Add current directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import json_dumps, json_loads, write_file_atomic
 
 # Import version information
 try:
@@ -29,21 +32,64 @@ except ImportError:
     def get_version_string():
         return "development"
 
+# Resolve the version once at import. With preload_app the Gunicorn workers
+# inherit the memoized result, so no request waits on the version file or git.
+get_version_info()
+
 # --- Configuration ---
 UPSC_CMD = "/usr/bin/upsc"
 POWER_MANAGER_CONFIG = "/etc/nut/power_manager.conf"
 UPS_CONF_FILE = "/etc/nut/ups.conf"
 CLIENT_STATUS_FILE = "/var/run/nut/client_status.json"
+# IP address of the Docker host reported to the clients, read once at startup
+SERVER_HOST_IP = os.environ.get('UPS_SERVER_HOST_IP')
+_SERVER_IP_MISSING_MSG = (
+    "CRITICAL: The 'UPS_SERVER_HOST_IP' environment variable is not set. "
+    "This variable must be defined in your .env file with the IP address "
+    "of the Docker host. The API cannot continue without it."
+)
+# How long a 'upsc' snapshot is served before the command is run again
+UPSC_CACHE_TTL_SECONDS = 1.0
+_UPSC_CACHE_CONTROL = f"max-age={max(1, int(UPSC_CACHE_TTL_SECONDS))}"
+# How long a request waits for a refresh already run by another request
+UPSC_REFRESH_WAIT_SECONDS = 2.0
 
 app = Flask(__name__)
 
+# Parsed configuration files, keyed by path: {path: (mtime_ns, size, parsed)}
+_CFG_CACHE = {}
+
+# Last 'upsc' snapshot served by /upsc, plus the event of the refresh in
+# progress (None when idle), which other requests wait on; both are
+# updated under _UPSC_LOCK
+_UPSC_CACHE = {"t": 0.0, "body": None, "refresh": None}
+_UPSC_LOCK = threading.Lock()
+
+# In-memory copy of CLIENT_STATUS_FILE and the (inode, mtime_ns, size) it matches
+_STATUS_CACHE = {"key": None, "data": {}}
+_STATUS_LOCK = threading.Lock()
+
 # --- Helper Functions ---
 
+def _json_response(obj, status=200):
+    """Builds a JSON response without going through Flask's jsonify."""
+    return Response(json_dumps(obj), status=status, mimetype='application/json')
+
+# Quote characters stripped from power_manager.conf values
+_QUOTES = ('"', "'")
+
+# Characters a numeric upsc value (int or float) can start with
+_NUMERIC_START = frozenset('+-.0123456789')
+
 def parse_upsc_value(value_str):
     """
     Tries to convert a string value to a more specific type (int, float).
     """
     value_str = value_str.strip()
+    # Only values that look numeric are worth the conversion attempts;
+    # status strings like "OL" fall straight through.
+    if value_str[:1] not in _NUMERIC_START:
+        return value_str
     # Try integer first
     try:
         return int(value_str)
@@ -57,156 +103,340 @@ def parse_upsc_value(value_str):
     # Fallback to the original string
     return value_str
 
-def build_nested_dict(flat_dict):
-    """
-    Converts a dictionary with dot-separated keys into a nested dictionary.
-    Handles key conflicts gracefully (e.g., 'driver.version' and
-    'driver.version.internal').
-    """
-    nested_dict = {}
-    # By sorting the keys, we ensure that parent keys (like 'driver.version')
-    # are processed before potential child keys ('driver.version.internal'),
-    # leading to a consistent and predictable structure.
-    for key, value in sorted(flat_dict.items()):
-        parts = key.split('.')
-        d = nested_dict
-        for i, part in enumerate(parts[:-1]):
-            # If the current path holds a value, we can't nest further.
-            # So, we create a key from the remaining parts and break.
-            if part in d and not isinstance(d[part], dict):
-                remaining_key = '.'.join(parts[i:])
-                d[remaining_key] = value
-                break
-            d = d.setdefault(part, {})
-        else:  # This 'else' belongs to the 'for' loop
-            # This block runs if the loop completed without a 'break'
-            # Check if the final key would overwrite a dictionary
-            final_key = parts[-1]
-            if final_key in d and isinstance(d[final_key], dict):
-                # A conflict where a parent node is also a value.
-                # e.g. 'driver.version' exists, and we have 'driver.version.internal'
-                # We can store the value with a special key, e.g., '_value'
-                d[final_key]['_value'] = value
-            else:
-                d[final_key] = value
-    return nested_dict
+def insert_nested_value(nested_dict, parts, value):
+    """
+    Stores a value in a nested dictionary under the path given by 'parts'.
+    A node that already holds a value cannot be nested further, so the
+    remaining parts are joined into a single dotted key at that level
+    (e.g. {'version': '2.8', 'version.internal': '0.4'}).
+    """
+    d = nested_dict
+    for i in range(len(parts) - 1):
+        part = parts[i]
+        child = d.get(part)
+        if child is None:
+            child = d[part] = {}
+        elif not isinstance(child, dict):
+            # The current path holds a value, so keep the rest as one key
+            d['.'.join(parts[i:])] = value
+            return
+        d = child
+
+    final_key = parts[-1]
+    children = d.get(final_key)
+    if isinstance(children, dict):
+        # Child keys arrived before their parent value; flatten them into
+        # dotted keys next to it, as if the parent had been stored first.
+        for sub_key, sub_value in _flatten_nested_dict(children):
+            d[f"{final_key}.{sub_key}"] = sub_value
+    d[final_key] = value
+
+def _flatten_nested_dict(nested_dict):
+    """Yields (dotted_key, value) pairs for every leaf of a nested dictionary."""
+    for key, value in nested_dict.items():
+        if isinstance(value, dict):
+            for sub_key, sub_value in _flatten_nested_dict(value):
+                yield f"{key}.{sub_key}", sub_value
+        else:
+            yield key, value
+
+def _load_cached(path, parser_fn):
+    """
+    Returns the parsed contents of a file, re-parsing it only when its
+    modification time or size has changed since the last call.
+    The cached object is shared between requests and must not be mutated.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        _CFG_CACHE.pop(path, None)
+        return parser_fn()
+
+    cached = _CFG_CACHE.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+
+    parsed = parser_fn()
+    _CFG_CACHE[path] = (st.st_mtime_ns, st.st_size, parsed)
+    return parsed
 
 def read_power_manager_config():
     """
     Read and parse power_manager.conf file to get both main config and wake hosts.
     Returns tuple (main_config_dict, wake_hosts_dict).
+    The file is only re-parsed when it changes on disk.
+    """
+    config, wake_hosts, _ = _load_cached(POWER_MANAGER_CONFIG, _parse_power_manager_config)
+    return config, wake_hosts
+
+def get_wake_host_index():
+    """
+    Returns a dict mapping a wake host IP address to its (section, params)
+    tuple. Built together with the parsed config, so lookups are O(1).
+    """
+    _, _, ip_index = _load_cached(POWER_MANAGER_CONFIG, _parse_power_manager_config)
+    return ip_index
+
+def _parse_power_manager_config():
+    """
+    Parses power_manager.conf from disk. Use read_power_manager_config()
+    instead, which caches the result.
+    Returns tuple (main_config_dict, wake_hosts_dict, ip_index_dict).
     """
     config = {}
     wake_hosts = {}
     
     if not os.path.exists(POWER_MANAGER_CONFIG):
-        return config, wake_hosts
+        return config, wake_hosts, {}
     
-    current_section = None
+    # Section whose keys are being read: the main config before the first
+    # header, a wake host dict, or None for sections the API ignores
+    # (e.g. [SCHEDULE_X]).
+    current = config
     with open(POWER_MANAGER_CONFIG, 'r') as f:
         for line in f:
             line = line.strip()
             if not line or line.startswith('#'):
                 continue
             
-            # Check for section headers [WAKE_HOST_X]
-            if line.startswith('[WAKE_HOST_') and line.endswith(']'):
-                current_section = line[1:-1]  # Remove brackets
-                wake_hosts[current_section] = {}
+            # Check for section headers
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1]  # Remove brackets
+                if section.startswith('WAKE_HOST_'):
+                    current = wake_hosts[section] = {}
+                else:
+                    current = None
                 continue
             
             # Parse key=value pairs
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip()
-                value = value.strip()
-                
-                # Remove quotes from values if present
-                if value.startswith('"') and value.endswith('"'):
-                    value = value[1:-1]
-                elif value.startswith("'") and value.endswith("'"):
-                    value = value[1:-1]
-                elif value.startswith('"'):
-                    value = value[1:]
-                elif value.endswith('"'):
-                    value = value[:-1]
-                elif value.startswith("'"):
-                    value = value[1:]
-                elif value.endswith("'"):
-                    value = value[:-1]
-                
-                if current_section:
-                    # This is a wake host parameter
-                    wake_hosts[current_section][key] = value
-                else:
-                    # This is a main config parameter
-                    config[key] = value
+            key, sep, value = line.partition('=')
+            if not sep or current is None:
+                continue
+            value = value.strip()
+            
+            # Remove quotes from values if present: a matching pair
+            # first, otherwise a single stray quote at either end
+            first, last = value[:1], value[-1:]
+            if first == last and first in _QUOTES:
+                value = value[1:-1]
+            elif first == '"':
+                value = value[1:]
+            elif last in _QUOTES:
+                value = value[:-1]
+            elif first == "'":
+                value = value[1:]
+            
+            current[key.strip()] = value
     
-    return config, wake_hosts
+    # Index wake hosts by IP; the first section defining an IP wins
+    ip_index = {}
+    for section, params in wake_hosts.items():
+        if 'IP' in params:
+            ip_index.setdefault(params['IP'], (section, params))
+    return config, wake_hosts, ip_index
 
 def get_client_ip():
     """
     Get the client's real IP address, considering proxies.
     """
-    if request.headers.getlist("X-Forwarded-For"):
-        return request.headers.getlist("X-Forwarded-For")[0]
-    else:
-        return request.remote_addr
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for:
+        # The left-most entry is the originating client
+        return forwarded_for.split(',', 1)[0].strip()
+    return request.remote_addr
 
 def get_server_ip():
     """
-    Determines the IP address for the UPS server from the environment.
+    Returns the IP address for the UPS server from the environment.
 
-    This function relies on the 'UPS_SERVER_HOST_IP' environment variable.
-    This variable is mandatory for the API to report the correct IP address
-    of the Docker host to the clients.
+    This function relies on the 'UPS_SERVER_HOST_IP' environment variable,
+    which is read once at startup. This variable is mandatory for the API
+    to report the correct IP address of the Docker host to the clients.
     """
-    host_ip = os.environ.get('UPS_SERVER_HOST_IP')
-    if not host_ip:
+    if not SERVER_HOST_IP:
         # This is a critical configuration error. The application cannot
         # function correctly without it.
-        error_msg = (
-            "CRITICAL: The 'UPS_SERVER_HOST_IP' environment variable is not set. "
-            "This variable must be defined in your .env file with the IP address "
-            "of the Docker host. The API cannot continue without it."
-        )
-        app.logger.error(error_msg)
-        abort(500, description=error_msg)
-    
-    app.logger.info(f"Using server IP from UPS_SERVER_HOST_IP environment variable: {host_ip}")
-    return host_ip
+        app.logger.error(_SERVER_IP_MISSING_MSG)
+        abort(500, description=_SERVER_IP_MISSING_MSG)
+    return SERVER_HOST_IP
 
 def get_ups_name():
     """
-    Parses ups.conf to find the name of the UPS, which is the first section
-    defined in the file (e.g., [ups]). This method avoids using configparser
-    to handle files with global settings outside of sections.
+    Returns the name of the UPS, which is the first section defined in
+    ups.conf (e.g., [ups]). The file is only re-read when it changes.
     """
     try:
-        with open(UPS_CONF_FILE, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                # Ignore comments and empty lines
-                if not line or line.startswith('#'):
-                    continue
-
-                # Check for a section header
-                if line.startswith('[') and line.endswith(']'):
-                    # Extract the name between the brackets
-                    ups_name = line[1:-1].strip()
-                    if ups_name:
-                        return ups_name
-        # If the loop completes without finding a valid section header
-        raise ValueError(f"No UPS sections found in {UPS_CONF_FILE}")
-
+        return _load_cached(UPS_CONF_FILE, _parse_ups_name)
     except (FileNotFoundError, ValueError) as e:
         app.logger.error(f"Could not read UPS name: {e}")
         abort(500, description=str(e))
 
+def _parse_ups_name():
+    """
+    Parses ups.conf to find the name of the UPS. This method avoids using
+    configparser to handle files with global settings outside of sections.
+    """
+    with open(UPS_CONF_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            # Ignore comments and empty lines
+            if not line or line.startswith('#'):
+                continue
+
+            # Check for a section header
+            if line.startswith('[') and line.endswith(']'):
+                # Extract the name between the brackets
+                ups_name = line[1:-1].strip()
+                if ups_name:
+                    return ups_name
+    # If the loop completes without finding a valid section header
+    raise ValueError(f"No UPS sections found in {UPS_CONF_FILE}")
+
+def read_ups_status():
+    """
+    Runs the 'upsc' command and returns its output as a nested dictionary,
+    including the power outage simulation flag. Aborts the request with
+    500 if the command cannot be executed.
+    """
+    # 1. --- Get UPS Name and run the upsc command ---
+    try:
+        ups_name = get_ups_name()
+        command = [UPSC_CMD, f"{ups_name}@localhost"]
+        app.logger.debug(f"Executing command: {' '.join(command)}")
+
+        # Output is kept as bytes; only the parsed keys and values are decoded
+        result = subprocess.run(
+            command,
+            capture_output=True,
+            check=True  # Raises CalledProcessError on non-zero exit codes
+        )
+    except FileNotFoundError:
+        msg = f"Server error: The command '{UPSC_CMD}' was not found."
+        app.logger.error(msg)
+        abort(500, description=msg)
+    except subprocess.CalledProcessError as e:
+        msg = f"Error executing upsc command: {e.stderr.decode('utf-8', 'replace').strip()}"
+        app.logger.error(msg)
+        abort(500, description=msg)
+
+    # 2. --- Parse the output directly into a nested dictionary ---
+    nested_data = {}
+    for line in result.stdout.splitlines():
+        key, sep, value = line.partition(b':')
+        if not sep:
+            continue
+        insert_nested_value(nested_data,
+                            key.strip().decode('utf-8', 'replace').split('.'),
+                            parse_upsc_value(value.decode('utf-8', 'replace')))
+
+    # 3. --- Add simulation mode information ---
+    try:
+        main_config, _ = read_power_manager_config()
+        simulation_mode = main_config.get('POWER_SIMULATION_MODE', 'false').lower()
+
+        # Add simulation parameter to the ups section
+        if 'ups' not in nested_data:
+            nested_data['ups'] = {}
+
+        # Convert "true"/"false" string to boolean for cleaner JSON
+        nested_data['ups']['simulation'] = simulation_mode == 'true'
+
+        app.logger.debug(f"Added simulation mode to UPS status: {simulation_mode}")
+    except Exception as e:
+        app.logger.warning(f"Could not read simulation mode from config: {e}. Defaulting to false.")
+        if 'ups' not in nested_data:
+            nested_data['ups'] = {}
+        nested_data['ups']['simulation'] = False
+
+    app.logger.debug("Successfully retrieved and parsed UPS status.")
+    return nested_data
+
+def _is_upsc_cache_fresh():
+    """Returns True if the cached 'upsc' snapshot is younger than the TTL."""
+    return (_UPSC_CACHE["body"] is not None and
+            time.monotonic() - _UPSC_CACHE["t"] < UPSC_CACHE_TTL_SECONDS)
+
+def get_cached_ups_status():
+    """
+    Returns the UPS status as serialized JSON bytes, refreshing it when it
+    is older than UPSC_CACHE_TTL_SECONDS. Only one request runs 'upsc' at a
+    time; requests arriving during a refresh wait for its result instead of
+    starting another 'upsc' process (or get the previous snapshot if the
+    refresh takes longer than UPSC_REFRESH_WAIT_SECONDS).
+    """
+    if _is_upsc_cache_fresh():
+        return _UPSC_CACHE["body"]
+
+    while True:
+        with _UPSC_LOCK:
+            if _is_upsc_cache_fresh():
+                return _UPSC_CACHE["body"]
+            refresh = _UPSC_CACHE["refresh"]
+            if refresh is None:
+                # No refresh running; this request runs 'upsc', with a new
+                # event so no one can mistake an earlier refresh for it
+                refresh = _UPSC_CACHE["refresh"] = threading.Event()
+                break
+        # Another request is already refreshing; reuse its result
+        refresh.wait(timeout=UPSC_REFRESH_WAIT_SECONDS)
+        if _UPSC_CACHE["body"] is not None:
+            return _UPSC_CACHE["body"]
+        # Nothing cached yet (e.g. that refresh failed), try again
+
+    try:
+        # Serialize once here, so cache hits send the bytes as they are
+        body = json_dumps(read_ups_status())
+        with _UPSC_LOCK:
+            _UPSC_CACHE["body"] = body
+            _UPSC_CACHE["t"] = time.monotonic()
+        return body
+    finally:
+        with _UPSC_LOCK:
+            _UPSC_CACHE["refresh"] = None
+        refresh.set()
+
+def _load_client_statuses():
+    """
+    Returns the client statuses, re-reading CLIENT_STATUS_FILE only when it
+    was replaced by another process (API worker or power manager) since it
+    was last read or written here. Callers must hold _STATUS_LOCK.
+    """
+    try:
+        st = os.stat(CLIENT_STATUS_FILE)
+    except FileNotFoundError:
+        _STATUS_CACHE["key"] = None
+        _STATUS_CACHE["data"] = {}
+        return _STATUS_CACHE["data"]
+
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if _STATUS_CACHE["key"] != key:
+        try:
+            with open(CLIENT_STATUS_FILE, 'rb') as f:
+                _STATUS_CACHE["data"] = json_loads(f.read())
+        except (IOError, json.JSONDecodeError):
+            _STATUS_CACHE["data"] = {}
+        _STATUS_CACHE["key"] = key
+    return _STATUS_CACHE["data"]
+
+def _save_client_statuses(statuses):
+    """
+    Atomically replaces CLIENT_STATUS_FILE with the given statuses and
+    remembers the written file, so the next request can skip re-reading it.
+    Callers must hold _STATUS_LOCK.
+    """
+    st = write_file_atomic(CLIENT_STATUS_FILE, json_dumps(statuses))
+    _STATUS_CACHE["key"] = (st.st_ino, st.st_mtime_ns, st.st_size)
+
 def load_api_token():
     """
-    Loads the API_TOKEN from power_manager.conf with a fallback for backward compatibility.
+    Loads the API_TOKEN from the UPS_API_TOKEN environment variable or from
+    power_manager.conf, with a fallback for backward compatibility.
     """
+    token = os.environ.get('UPS_API_TOKEN')
+    if token:
+        app.logger.info("Using API_TOKEN from the UPS_API_TOKEN environment variable.")
+        return token
+
     main_config, _ = read_power_manager_config()
     token = main_config.get('API_TOKEN')
 
@@ -226,6 +456,26 @@ def load_api_token():
 
 # Load the API token once when the application starts
 API_TOKEN = load_api_token()
+# Expected Authorization header as bytes, built once instead of on every request
+_EXPECTED_AUTH = f"Bearer {API_TOKEN}".encode('utf-8')
+
+# Report the server IP once at startup rather than on every request
+if SERVER_HOST_IP:
+    app.logger.info(f"Using server IP from UPS_SERVER_HOST_IP environment variable: {SERVER_HOST_IP}")
+else:
+    app.logger.error(_SERVER_IP_MISSING_MSG)
+
+def _require_auth():
+    """
+    Aborts the request with 401 unless it carries a valid API token.
+    Uses a constant-time comparison against the precomputed header.
+    """
+    # Read the raw WSGI value directly instead of going through the
+    # case-insensitive header wrapper. WSGI decodes headers as latin-1, so
+    # encoding it back yields the bytes the client actually sent.
+    auth_header = request.environ.get('HTTP_AUTHORIZATION', '')
+    if not hmac.compare_digest(auth_header.encode('latin-1', 'replace'), _EXPECTED_AUTH):
+        abort(401, description="Unauthorized: Missing or invalid API token.")
 
 # --- API Endpoints ---
 
@@ -242,66 +492,20 @@ def get_upsc_data():
     """
     Endpoint to retrieve the live status of the UPS. It runs the 'upsc'
     command on the server and returns the data as a nested JSON object.
+    The result is cached for UPSC_CACHE_TTL_SECONDS so that polling clients
+    share a single 'upsc' invocation.
     """
     # 1. --- Security Check: Validate API Token ---
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f"Bearer {API_TOKEN}":
-        abort(401, description="Unauthorized: Missing or invalid API token.")
+    _require_auth()
 
-    app.logger.info("UPS status request received from a client.")
+    app.logger.debug("UPS status request received from a client.")
 
-    # 2. --- Get UPS Name and run the upsc command ---
-    try:
-        ups_name = get_ups_name()
-        command = [UPSC_CMD, f"{ups_name}@localhost"]
-        app.logger.info(f"Executing command: {' '.join(command)}")
+    # 2. --- Serve from cache or refresh it (one refresh at a time) ---
+    body = get_cached_ups_status()
 
-        result = subprocess.run(
-            command,
-            capture_output=True,
-            text=True,
-            check=True,  # Raises CalledProcessError on non-zero exit codes
-            encoding='utf-8'
-        )
-    except FileNotFoundError:
-        msg = f"Server error: The command '{UPSC_CMD}' was not found."
-        app.logger.error(msg)
-        abort(500, description=msg)
-    except subprocess.CalledProcessError as e:
-        msg = f"Error executing upsc command: {e.stderr.strip()}"
-        app.logger.error(msg)
-        abort(500, description=msg)
-
-    # 3. --- Parse the output into a flat dictionary ---
-    flat_data = {}
-    for line in result.stdout.strip().split('\n'):
-        key, value = line.split(':', 1)
-        flat_data[key.strip()] = parse_upsc_value(value.strip())
-
-    # 4. --- Convert to nested dictionary ---
-    nested_data = build_nested_dict(flat_data)
-
-    # 5. --- Add simulation mode information ---
-    try:
-        main_config, _ = read_power_manager_config()
-        simulation_mode = main_config.get('POWER_SIMULATION_MODE', 'false').lower()
-
-        # Add simulation parameter to the ups section
-        if 'ups' not in nested_data:
-            nested_data['ups'] = {}
-
-        # Convert "true"/"false" string to boolean for cleaner JSON
-        nested_data['ups']['simulation'] = simulation_mode == 'true'
-
-        app.logger.info(f"Added simulation mode to UPS status: {simulation_mode}")
-    except Exception as e:
-        app.logger.warning(f"Could not read simulation mode from config: {e}. Defaulting to false.")
-        if 'ups' not in nested_data:
-            nested_data['ups'] = {}
-        nested_data['ups']['simulation'] = False
-
-    app.logger.info(f"Successfully retrieved and parsed UPS status.")
-    return jsonify(nested_data)
+    # Let HTTP intermediaries reuse the snapshot for as long as we do
+    return Response(body, mimetype='application/json',
+                    headers={'Cache-Control': _UPSC_CACHE_CONTROL})
 
 @app.route('/config', methods=['GET'])
 def get_config():
@@ -311,27 +515,23 @@ def get_config():
     and a valid API token in the 'Authorization' header.
     """
     # 1. --- Security Check: Validate API Token ---
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f"Bearer {API_TOKEN}":
-        abort(401, description="Unauthorized: Missing or invalid API token.")
+    _require_auth()
 
     # 2. --- Get Client IP from the request ---
     client_ip = request.args.get('ip')
     if not client_ip:
         client_ip = get_client_ip()
         
-    app.logger.info(f"Configuration request received for IP: {client_ip}")
+    # Per-request details are only formatted when debug logging is enabled
+    debug_enabled = app.logger.isEnabledFor(logging.DEBUG)
+    if debug_enabled:
+        app.logger.debug(f"Configuration request received for IP: {client_ip}")
 
     # 3. --- Read power_manager.conf and find client configuration ---
     try:
-        main_config, wake_hosts = read_power_manager_config()
-        
         # Look for the client IP in wake hosts sections
-        client_config = None
-        for section, params in wake_hosts.items():
-            if params.get('IP') == client_ip:
-                client_config = params.copy()
-                break
+        hit = get_wake_host_index().get(client_ip)
+        client_config = hit[1].copy() if hit else None
         
         if not client_config:
             app.logger.warning(f"No configuration section found for IP: {client_ip}")
@@ -358,8 +558,9 @@ def get_config():
         ignore_simulation = client_config.get('IGNORE_SIMULATION', 'false').lower()
         response_config['IGNORE_SIMULATION'] = ignore_simulation == 'true'
 
-        app.logger.info(f"Generated configuration for {client_ip}: {response_config}")
-        return jsonify(response_config)
+        if debug_enabled:
+            app.logger.debug(f"Generated configuration for {client_ip}: {response_config}")
+        return _json_response(response_config)
         
     except Exception as e:
         app.logger.error(f"Error reading configuration: {e}")
@@ -370,12 +571,13 @@ def update_client_status():
     """
     Endpoint for clients to post their status.
     """
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f"Bearer {API_TOKEN}":
-        abort(401, description="Unauthorized: Missing or invalid API token.")
+    _require_auth()
 
-    data = request.get_json()
-    if not data or 'ip' not in data or 'status' not in data:
+    try:
+        data = json_loads(request.get_data(cache=False))
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or 'ip' not in data or 'status' not in data:
         abort(400, description="Bad Request: Missing 'ip' or 'status' in JSON payload.")
 
     client_ip = data['ip']
@@ -383,37 +585,32 @@ def update_client_status():
         'status': data['status'],
         'remaining_seconds': data.get('remaining_seconds', None),
         'shutdown_delay': data.get('shutdown_delay', None),
-        'timestamp': datetime.utcnow().isoformat() + "Z"
+        # Same second-resolution format the power manager writes
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
     }
 
-    # Read existing statuses
-    try:
-        if os.path.exists(CLIENT_STATUS_FILE):
-            with open(CLIENT_STATUS_FILE, 'r') as f:
-                statuses = json.load(f)
-        else:
-            statuses = {}
-    except (IOError, json.JSONDecodeError):
-        statuses = {}
+    with _STATUS_LOCK:
+        # Update status for the specific client
+        statuses = _load_client_statuses()
+        statuses[client_ip] = client_status
 
-    # Update status for the specific client
-    statuses[client_ip] = client_status
-    
-    # Write back to the file atomically
-    try:
-        temp_file = CLIENT_STATUS_FILE + ".tmp"
-        with open(temp_file, 'w') as f:
-            json.dump(statuses, f)
-        # Atomic move operation
-        os.rename(temp_file, CLIENT_STATUS_FILE)
-    except IOError as e:
-        app.logger.error(f"Could not write client status file: {e}")
-        abort(500, description="Server error: Could not write status file.")
+        # Write back to the file atomically
+        try:
+            _save_client_statuses(statuses)
+        except IOError as e:
+            # Force a re-read so the in-memory copy matches the file again
+            _STATUS_CACHE["key"] = None
+            app.logger.error(f"Could not write client status file: {e}")
+            abort(500, description="Server error: Could not write status file.")
 
-    return jsonify({"message": "Status updated successfully"}), 200
+    return _json_response({"message": "Status updated successfully"})
 
 if __name__ == '__main__':
-    # For production, use a proper WSGI server like Gunicorn or uWSGI.
-    # For debugging, you can run this script directly.
-    # Host '0.0.0.0' makes it accessible from other machines on the network.
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # In production the API runs under Gunicorn (see gunicorn_api.conf.py).
+    # The Flask development server is only started for debugging.
+    if os.environ.get("FLASK_DEBUG"):
+        # Host '0.0.0.0' makes it accessible from other machines on the network.
+        app.run(host='0.0.0.0', port=5000, debug=True)
+    else:
+        sys.exit("Run the API with 'gunicorn -c gunicorn_api.conf.py api:app', "
+                 "or set FLASK_DEBUG=1 to start the Flask development server.")
\ No newline at end of file
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+UPS Server Shared Helpers
+Author: MarekWo
+Description: Helpers used by more than one of the API, the Web GUI,
+             power_manager.py and version_info.py
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import re
+
+# orjson is considerably faster than the stdlib json module; fall back to
+# the latter if it is not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_dumps(obj, indent=False):
+    """Serializes an object to JSON bytes: compact, or indented by two spaces."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(obj, indent=2).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+def json_loads(data):
+    """Parses JSON from bytes or str. Raises json.JSONDecodeError on bad input."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def write_file_atomic(filepath, content):
+    """Replace filepath with content (str or bytes) via a temp file and os.replace.
+
+    Mode and ownership of an existing file are kept (e.g. the nut-owned
+    virtual device file), so readers only ever see the old or new content.
+    The data is synced before the rename, so a power loss right after a
+    save cannot leave an empty file behind (the config lives on disk).
+    Returns the os.stat_result of the new file.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    tmp_path = f"{filepath}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as tmp:
+            tmp.write(content)
+            tmp.flush()
+            try:
+                st = os.stat(filepath)
+                os.fchmod(tmp.fileno(), st.st_mode & 0o7777)
+                # Keep files editable by their owner (e.g. the config on the host)
+                os.fchown(tmp.fileno(), st.st_uid, st.st_gid)
+            except (FileNotFoundError, PermissionError):
+                pass
+            os.fsync(tmp.fileno())
+            # The rename below keeps the inode, mtime and size
+            new_st = os.fstat(tmp.fileno())
+        os.replace(tmp_path, filepath)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return new_st
+
+# --- power_manager.conf ---
+
+# Held by every process rewriting power_manager.conf (power_manager and the Web GUI)
+CONFIG_LOCK_FILE = "/var/run/nut/power_manager.conf.lock"
+
+# A single line of power_manager.conf: either a [section] header (group 1)
+# or a key=value pair (groups 2 and 3). Blank lines, comments and lines
+# without '=' do not match and are skipped by the scan.
+CONFIG_LINE_RE = re.compile(
+    rb'^[^\S\n]*(?:\[([^\n]*)\]|([^\s#=][^\n=]*)?=([^\n]*))[^\S\n]*$',
+    re.MULTILINE
+)
+
+# Last parsed power_manager.conf, keyed by config_file_key()
+_CONFIG_CACHE = {'key': None, 'data': None}
+
+@contextlib.contextmanager
+def config_lock():
+    """Holds the lock that serializes all rewrites of power_manager.conf.
+
+    The config is replaced rather than rewritten in place, so a lock on the
+    config file itself would be left on the old inode. A separate lock file
+    keeps the read-modify-write of every writer in order.
+    """
+    with open(CONFIG_LOCK_FILE, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        yield
+
+def config_file_key(path):
+    """Return path's (path, inode, mtime, size), or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (path, st.st_ino, st.st_mtime_ns, st.st_size)
+
+def parse_power_manager_config(content):
+    """Parse raw power_manager.conf bytes into (config, wake_hosts, schedules) dicts.
+
+    The file is scanned as bytes and only the matched sections, keys and
+    values are decoded, instead of decoding and splitting the whole file.
+    """
+    config = {}
+    wake_hosts = {}
+    schedules = {}
+    current_section = None
+
+    for match in CONFIG_LINE_RE.finditer(content):
+        section, key, value = match.groups()
+
+        # Check for section headers
+        if section is not None:
+            current_section = section.decode('utf-8', 'replace')
+            if current_section.startswith('WAKE_HOST_'):
+                wake_hosts[current_section] = {}
+            elif current_section.startswith('SCHEDULE_'):
+                schedules[current_section] = {}
+            else:
+                # Reset if it's not a known section type, allowing for future sections
+                current_section = None
+            continue
+
+        # Parse key=value pairs
+        key = key.strip().decode('utf-8', 'replace') if key else ''
+        # Remove quotes from values if present, strip whitespace again
+        value = value.strip().strip(b'"\'').strip().decode('utf-8', 'replace')
+
+        if current_section:
+            if current_section.startswith('WAKE_HOST_'):
+                wake_hosts[current_section][key] = value
+            elif current_section.startswith('SCHEDULE_'):
+                schedules[current_section][key] = value
+        else:
+            # This is a main config parameter
+            config[key] = value
+
+    return config, wake_hosts, schedules
+
+def load_power_manager_config(path):
+    """Read and parse power_manager.conf into (config, wake_hosts, schedules) dicts.
+
+    The parsed result is kept in memory and reused while the file's inode,
+    mtime and size are unchanged. A missing file gives empty dicts; other
+    read errors raise IOError.
+    """
+    cache_key = config_file_key(path)
+    if cache_key is None:
+        return {}, {}, {}
+
+    if _CONFIG_CACHE['key'] != cache_key:
+        with open(path, 'rb') as f:
+            content = f.read()
+        _CONFIG_CACHE['data'] = parse_power_manager_config(content)
+        _CONFIG_CACHE['key'] = cache_key
+
+    # Callers update their copy in place (e.g. POWER_SIMULATION_MODE),
+    # so hand out fresh dicts and keep the cached ones untouched.
+    config, wake_hosts, schedules = _CONFIG_CACHE['data']
+    return (dict(config),
+            {section: dict(params) for section, params in wake_hosts.items()},
+            {section: dict(params) for section, params in schedules.items()})
+
+def cache_power_manager_config(path, content, st):
+    """Remember the parse of content just written to path (st: its os.stat_result)."""
+    _CONFIG_CACHE['data'] = parse_power_manager_config(content)
+    _CONFIG_CACHE['key'] = (path, st.st_ino, st.st_mtime_ns, st.st_size)
+
+def invalidate_power_manager_config():
+    """Make the next load_power_manager_config() re-read the file."""
+    _CONFIG_CACHE['key'] = None
+
+# --- Wake-on-LAN ---
+
+# Wake-on-LAN magic packets go to the discard port, like the wakeonlan tool
+WOL_PORT = 9
+WOL_DEFAULT_BROADCAST = "255.255.255.255"
+# Separators stripped from a MAC address before hex decoding
+_MAC_SEPARATORS = str.maketrans('', '', ':-.')
+
+def build_magic_packet(mac):
+    """Build a Wake-on-LAN magic packet: 6 x 0xFF followed by the MAC 16 times."""
+    hex_digits = mac.translate(_MAC_SEPARATORS)
+    mac_bytes = bytes.fromhex(hex_digits)
+    if len(mac_bytes) != 6:
+        raise ValueError(f"Invalid MAC address: {mac}")
+    return b'\xff' * 6 + mac_bytes * 16
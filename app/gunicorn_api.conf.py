@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+"""
+Gunicorn configuration for the UPS Hub API
+Author: MarekWo
+Description: Started from entrypoint.sh with 'gunicorn -c gunicorn_api.conf.py api:app'.
+             Deliberately not named gunicorn.conf.py, so that the Web GUI
+             Gunicorn instance (also started in /app) does not pick it up.
+"""
+
+import os
+
+bind = "0.0.0.0:5000"
+chdir = "/app"
+
+# Threaded workers let one process serve several polling clients while
+# another request waits on the 'upsc' command. The API is a light poller and
+# each worker keeps its own upsc cache, so a fixed 3 workers are enough
+# (cpu_count() would see the host's cores, not the container's limit).
+# Override the worker count with GUNICORN_API_WORKERS.
+worker_class = "gthread"
+workers = int(os.environ.get("GUNICORN_API_WORKERS", 3))
+threads = 4
+
+# Import the app once in the master, so the token and parsed configuration
+# are loaded a single time and shared copy-on-write with the workers.
+preload_app = True
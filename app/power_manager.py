@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import atexit
+import functools
 import os
+import queue
+import select
+import socket
+import struct
 import sys
 import subprocess
 import json
@@ -9,10 +15,13 @@ import logging
 import logging.handlers
 import fcntl
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import smtplib
-from email.mime.text import MIMEText
-from email.utils import formataddr
+
+from common import (CONFIG_LINE_RE, WOL_DEFAULT_BROADCAST, WOL_PORT, build_magic_packet,
+                    cache_power_manager_config, config_file_key, config_lock,
+                    invalidate_power_manager_config, json_dumps, json_loads,
+                    load_power_manager_config, write_file_atomic)
 
 # --- Constants ---
 APP_NAME = "PowerManager"
@@ -31,21 +40,60 @@ CHECK_INTERVAL_SECONDS = 15
 
 # Commands
 PING_CMD = "/bin/ping"
-WAKEONLAN_CMD = "/usr/bin/wakeonlan"
+
+
+# Minimum seconds between two notifications of the same type. Types not
+# listed are never debounced; override with DEBOUNCE_<TYPE>_SECONDS in the config.
+DEFAULT_DEBOUNCE_SECONDS = {"APP_ERROR": 3600}
+
+# In-process ICMP echo: seconds to wait for replies (same as 'ping -W 1')
+ICMP_REPLY_TIMEOUT_SECONDS = 1
+
+# Last parsed CLIENT_STATUS_FILE, keyed by the file's (inode, mtime, size)
+_CLIENT_STATUS_CACHE = {'key': None, 'data': None}
+
+# ICMP socket reused by every ping round of the process (False: not permitted)
+# and the sequence number of the last echo request sent on it
+_icmp_socket = None
+_icmp_seq = 0
 
 # --- Logger Setup ---
+# Background thread that writes queued log records to the file and syslog
+_log_listener = None
+
 def setup_logging(debug_mode=False):
-    """Configures logging to file and syslog with optional debug level."""
+    """Configures logging to file and syslog with optional debug level.
+
+    The logger itself only gets a QueueHandler; a QueueListener thread does
+    the actual file writes and syslog sends, so a slow disk or syslog daemon
+    never stalls a power check.
+    """
+    global _log_listener
     logger = logging.getLogger(APP_NAME)
     logger.setLevel(logging.DEBUG if debug_mode else logging.INFO)
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S')
 
-    # File handler for detailed logs
+    # When reconfiguring, detach the previous QueueHandler first, so nothing
+    # is queued where no listener reads it, then stop the listener (flushing
+    # its queue)
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+    if _log_listener is not None:
+        _log_listener.stop()
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
+
+    handlers = []
+    syslog_error = None
+
+    # File handler for detailed logs; reopens the file after logrotate moves it
     try:
-        file_handler = logging.FileHandler(LOG_FILE)
+        file_handler = logging.handlers.WatchedFileHandler(LOG_FILE)
         file_handler.setLevel(logging.DEBUG if debug_mode else logging.INFO)
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
     except IOError as e:
         print(f"Warning: Cannot write to log file {LOG_FILE}: {e}", file=sys.stderr)
 
@@ -55,12 +103,43 @@ def setup_logging(debug_mode=False):
         syslog_formatter = logging.Formatter(f'{APP_NAME}[%(process)d]: %(message)s')
         syslog_handler.setFormatter(syslog_formatter)
         syslog_handler.setLevel(logging.INFO)
-        logger.addHandler(syslog_handler)
-    except (IOError, OSError):
+        handlers.append(syslog_handler)
+    except (IOError, OSError) as e:
+        syslog_error = e
+
+    if handlers:
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _log_listener.start()
+
+    if syslog_error is not None:
         logger.warning("Could not connect to syslog. Logging to file only.")
 
     return logger
 
+def set_debug_logging(debug_mode):
+    """Switches the logger and its file handler between INFO and DEBUG in place.
+
+    Unlike setup_logging, this keeps the open log file, syslog socket and
+    listener thread.
+    """
+    level = logging.DEBUG if debug_mode else logging.INFO
+    logger = logging.getLogger(APP_NAME)
+    logger.setLevel(level)
+    if _log_listener is not None:
+        for handler in _log_listener.handlers:
+            if isinstance(handler, logging.FileHandler):
+                handler.setLevel(level)
+    return logger
+
+def _stop_log_listener():
+    """Flush queued log records before the interpreter exits."""
+    if _log_listener is not None:
+        _log_listener.stop()
+
+atexit.register(_stop_log_listener)
+
 # Initial logger setup (will be reconfigured after reading config)
 log = setup_logging()
 
@@ -68,115 +147,317 @@ log = setup_logging()
 
 def read_power_manager_config():
     """
-    Read and parse power_manager.conf file - EXACT REPLICA of web_gui.py function
-    to ensure 100% compatibility with existing Web GUI.
+    Read and parse power_manager.conf file with the same parser as the Web GUI.
+
+    The parsed result is kept in memory and reused while the file is unchanged
+    on disk, so the per-iteration PowerManager instances do not re-parse it.
     """
-    config = {}
-    wake_hosts = {}
-    schedules = {}
-    current_section = None
-    
-    if not os.path.exists(CONFIG_FILE):
-        return config, wake_hosts, schedules
-    
     try:
-        with open(CONFIG_FILE, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                
-                # Check for section headers
-                if line.startswith('[') and line.endswith(']'):
-                    current_section = line[1:-1]
-                    if current_section.startswith('WAKE_HOST_'):
-                        wake_hosts[current_section] = {}
-                    elif current_section.startswith('SCHEDULE_'):
-                        schedules[current_section] = {}
-                    else:
-                        # Reset if it's not a known section type, allowing for future sections
-                        current_section = None 
-                    continue
-                
-                # Parse key=value pairs
-                if '=' in line:
-                    try:
-                        key, value = line.split('=', 1)
-                        key = key.strip()
-                        # Remove quotes from values if present, strip whitespace again
-                        value = value.strip().strip('"\'').strip()
-
-                        if current_section:
-                            if current_section.startswith('WAKE_HOST_'):
-                                wake_hosts[current_section][key] = value
-                            elif current_section.startswith('SCHEDULE_'):
-                                schedules[current_section][key] = value
-                        else:
-                            # This is a main config parameter
-                            config[key] = value
-                    except ValueError as e:
-                        log.warning(f"Invalid config line: {line} - {e}")
+        return load_power_manager_config(CONFIG_FILE)
     except IOError as e:
         log.error(f"Cannot read config file: {e}")
         raise
-    
-    return config, wake_hosts, schedules
 
 def save_setting_to_config(key, value, section=None):
-    """Safely saves a single setting back to the config file with file locking."""
+    """Safely saves a single setting back to the config file with file locking.
+
+    The new content is written to a temporary file that then replaces the
+    config, so the Web GUI never reads a half-written file, and the cached
+    parse is refreshed from that content instead of reading the file back.
+    """
     section = section or None  # Main config section
+    # The file is handled as bytes, like read_power_manager_config() does
+    key_bytes = key.encode('utf-8')
+    section_bytes = section.encode('utf-8') if section is not None else None
+    new_line = f'{key}="{value}"\n'.encode('utf-8')
     
     try:
         # Use file locking to prevent race conditions
-        with open(CONFIG_FILE, 'r+') as f:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            
+        with config_lock(), open(CONFIG_FILE, 'rb') as f:
             lines = f.readlines()
-            f.seek(0)
-            f.truncate()
             
             in_correct_section = section is None  # True for main config
             key_found = False
             
-            for line in lines:
-                stripped = line.strip()
-                
-                # Check for section headers
-                if stripped.startswith('[') and stripped.endswith(']'):
-                    current_section = stripped[1:-1]
-                    in_correct_section = current_section == section
-                    f.write(line)
+            for i, line in enumerate(lines):
+                # Same line classification as the parser; comments don't match
+                match = CONFIG_LINE_RE.match(line)
+                if match is None:
                     continue
+                line_section, line_key = match.group(1, 2)
                 
-                # Check for our key in the correct section
-                if in_correct_section and '=' in stripped and not stripped.startswith('#'):
-                    line_key = stripped.split('=')[0].strip()
-                    if line_key == key:
-                        # Preserve original formatting but update value
-                        indent = len(line) - len(line.lstrip())
-                        f.write(' ' * indent + f'{key}="{value}"\n')
-                        key_found = True
-                        continue
-                
-                f.write(line)
+                # Check for section headers
+                if line_section is not None:
+                    in_correct_section = line_section == section_bytes
+                elif in_correct_section and line_key and line_key.strip() == key_bytes:
+                    # Preserve original formatting but update value
+                    indent = len(line) - len(line.lstrip())
+                    lines[i] = b' ' * indent + new_line
+                    key_found = True
             
             # If key wasn't found, add it to the end of the correct section
             if not key_found:
                 if section is not None:
-                    f.write(f'\n[{section}]\n')
-                f.write(f'{key}="{value}"\n')
-                
+                    lines.append(b'\n[' + section_bytes + b']\n')
+                lines.append(new_line)
+
+            content = b''.join(lines)
+            new_st = write_file_atomic(CONFIG_FILE, content)
+
     except IOError as e:
+        invalidate_power_manager_config()
         log.error(f"Failed to save setting {key}={value}: {e}")
         raise
 
+    cache_power_manager_config(CONFIG_FILE, content, new_st)
+
+def _parse_bool(value):
+    """Parses a 'true'/'false' state file value."""
+    return value.lower() == 'true'
+
+def _parse_optional_json(value):
+    """Parses a JSON state file value, where empty or 'null' means None."""
+    return json_loads(value) if value and value != 'null' else None
+
+def _touch(filepath):
+    """Create filepath if it does not exist; returns True when it was created.
+
+    O_CREAT | O_EXCL checks and creates in one call, without the race of a
+    separate os.path.exists() test.
+    """
+    try:
+        os.close(os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    except FileExistsError:
+        return False
+    return True
+
+def _read_client_statuses():
+    """Read and parse CLIENT_STATUS_FILE, reusing the last parse while the file is unchanged.
+
+    Most checks of a run find the file as the previous one left it, so they
+    cost one stat(). The returned dict is shared: copy it before modifying.
+    Raises FileNotFoundError, IOError or json.JSONDecodeError like a plain read.
+    """
+    st = os.stat(CLIENT_STATUS_FILE)
+    cache_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    if _CLIENT_STATUS_CACHE['key'] != cache_key:
+        with open(CLIENT_STATUS_FILE, 'rb') as f:
+            _CLIENT_STATUS_CACHE['data'] = json_loads(f.read())
+        _CLIENT_STATUS_CACHE['key'] = cache_key
+    return _CLIENT_STATUS_CACHE['data']
+
+@functools.lru_cache(maxsize=256)
+def _parse_client_timestamp(timestamp_str):
+    """Parse a client status timestamp (ISO 8601 or RFC 3339) into a naive UTC datetime.
+
+    Clients report every few minutes, so most timestamps are seen again on
+    the next checks of the run; those are answered from the cache.
+    """
+    # Handle both ISO format and RFC3339 format
+    if timestamp_str.endswith('Z'):
+        ts = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+    else:
+        ts = datetime.fromisoformat(timestamp_str)
+
+    # Convert to UTC if necessary
+    if ts.tzinfo is not None:
+        ts = ts.replace(tzinfo=None)
+    return ts
+
+def _open_icmp_socket():
+    """Open an ICMP socket: unprivileged datagram ICMP if allowed, else raw."""
+    for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+        try:
+            return socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP)
+        except OSError:
+            continue
+    return None
+
+def _get_icmp_socket():
+    """Return the ICMP socket shared by all ping rounds of this process, or None.
+
+    The socket is opened on first use; if ICMP sockets are not permitted the
+    failure is remembered so later rounds go straight to the ping fallback.
+    """
+    global _icmp_socket
+    if _icmp_socket is None:
+        _icmp_socket = _open_icmp_socket() or False
+    return _icmp_socket or None
+
+def _icmp_checksum(data):
+    """Internet checksum (RFC 1071) of an ICMP message."""
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+def _icmp_echo_request(ident, seq):
+    """Build an ICMP echo request with a small fixed payload."""
+    payload = b'power_manager'
+    header = struct.pack('!BBHHH', 8, 0, 0, ident, seq)
+    checksum = _icmp_checksum(header + payload)
+    return struct.pack('!BBHHH', 8, 0, checksum, ident, seq) + payload
+
+def _gethostbyname(host):
+    """Resolve host to an IPv4 address string, or None if it cannot be resolved."""
+    try:
+        return socket.gethostbyname(host)
+    except OSError:
+        return None
+
+def _resolve_ipv4(hosts):
+    """Map each host to its IPv4 address (or None).
+
+    IPv4 literals, the usual case, need no lookup; host names are resolved
+    in parallel so one slow DNS answer does not delay the others.
+    """
+    addresses = {}
+    names = []
+    for host in hosts:
+        try:
+            socket.inet_pton(socket.AF_INET, host)
+            addresses[host] = host
+        except OSError:
+            names.append(host)
+
+    if names:
+        with ThreadPoolExecutor(max_workers=min(32, len(names))) as executor:
+            addresses.update(zip(names, executor.map(_gethostbyname, names)))
+    return addresses
+
+def _icmp_ping_hosts(ips, stop_on_first=False):
+    """Send one ICMP echo request to each host from a single socket.
+
+    Returns (results, unhandled): results maps each probed IP to True/False,
+    unhandled lists the hosts that could not be probed this way (no ICMP
+    socket permission, unresolvable or non-IPv4 address).
+    """
+    global _icmp_seq
+    sock = _get_icmp_socket()
+    if sock is None:
+        return {}, list(ips)
+
+    results = {}
+    unhandled = []
+    pending = {}  # resolved address -> hosts waiting for its reply
+    sent_seqs = set()
+    ident = os.getpid() & 0xFFFF
+    is_raw = sock.type == socket.SOCK_RAW
+
+    addresses = _resolve_ipv4(ips)
+    for ip in ips:
+        addr = addresses[ip]
+        # Sequence numbers keep running across rounds, so late replies to an
+        # earlier round still queued on the shared socket are ignored
+        _icmp_seq = _icmp_seq % 0xFFFF + 1
+        try:
+            if addr is None:
+                raise OSError(f"No IPv4 address for {ip}")
+            sock.sendto(_icmp_echo_request(ident, _icmp_seq), (addr, 0))
+        except OSError:
+            unhandled.append(ip)
+            continue
+        sent_seqs.add(_icmp_seq)
+        pending.setdefault(addr, []).append(ip)
+
+    deadline = time.monotonic() + ICMP_REPLY_TIMEOUT_SECONDS
+    while pending:
+        if stop_on_first and results:
+            return results, unhandled
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+            break
+        try:
+            packet, (addr, _) = sock.recvfrom(1024)
+        except OSError:
+            continue
+        if is_raw:
+            # Raw sockets see the IP header and every ICMP packet on the host
+            packet = packet[(packet[0] & 0x0F) * 4:]
+            if len(packet) < 8 or struct.unpack('!H', packet[4:6])[0] != ident:
+                continue
+        if (len(packet) >= 8 and packet[0] == 0 and addr in pending
+                and struct.unpack('!H', packet[6:8])[0] in sent_seqs):
+            for ip in pending.pop(addr):
+                results[ip] = True
+
+    for hosts in pending.values():
+        for ip in hosts:
+            results[ip] = False
+    return results, unhandled
+
+def ping_hosts(ips, timeout=3, stop_on_first=False):
+    """Ping several hosts concurrently.
+
+    Hosts are probed in-process over a single ICMP socket; any host that
+    cannot be probed that way falls back to one /bin/ping process per host.
+
+    Returns a dict mapping each IP to True (reply), False (no reply) or None
+    (ping could not be run or did not finish within `timeout` seconds).
+    With stop_on_first=True the remaining pings are abandoned as soon as one
+    host replies, and those hosts are left out of the result.
+    """
+    results, fallback_ips = _icmp_ping_hosts(list(dict.fromkeys(ips)), stop_on_first)
+    if stop_on_first and any(results.values()):
+        return results
+
+    procs = {}
+    pidfds = {}  # ip -> pidfd that becomes readable when that ping exits
+    for ip in fallback_ips:
+        try:
+            procs[ip] = subprocess.Popen([PING_CMD, "-c", "1", "-W", "1", ip],
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            log.warning(f"Cannot start ping for {ip}: {e}")
+            results[ip] = None
+            continue
+        try:
+            pidfds[ip] = os.pidfd_open(procs[ip].pid)
+        except (AttributeError, OSError):
+            pass  # No pidfd support: fall back to short sleeps below
+
+    deadline = time.monotonic() + timeout
+    try:
+        while procs:
+            for ip, proc in list(procs.items()):
+                returncode = proc.poll()
+                if returncode is not None:
+                    results[ip] = returncode == 0
+                    del procs[ip]
+                    if ip in pidfds:
+                        os.close(pidfds.pop(ip))
+            if stop_on_first and any(results.values()):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                results.update(dict.fromkeys(procs))
+                break
+            if procs and len(pidfds) == len(procs):
+                # Sleep until one of the pings exits instead of busy-polling
+                select.select(list(pidfds.values()), [], [], remaining)
+            elif procs:
+                time.sleep(min(remaining, 0.01))
+    finally:
+        for proc in procs.values():
+            proc.kill()
+            proc.wait()
+        for fd in pidfds.values():
+            os.close(fd)
+
+    return results
+
 class Notifier:
     """Handles sending email notifications."""
     def __init__(self, config):
         self.config = config
         self.debounce_file = NOTIFICATION_STATE_FILE
-        if not os.path.exists(self.debounce_file):
-            open(self.debounce_file, 'a').close()
+        self._debounce = self._load_debounce_state()
+        # SMTP connection shared by all notifications of one power check
+        self._server = None
+        # SMTP settings and headers, parsed on the first notification sent
+        self._smtp_settings = None
 
     def send(self, n_type, subject, body):
         """Sends a notification if enabled and not debounced."""
@@ -185,11 +466,11 @@ class Notifier:
             log.info(f"Notification for {n_type} is disabled. Skipping.")
             return
 
-        if n_type == "APP_ERROR":
-            debounce_seconds = 3600
+        debounce_seconds = self._debounce_seconds(n_type)
+        if debounce_seconds > 0:
             last_sent = self._get_debounce_timestamp(n_type)
             if last_sent and (datetime.now() - last_sent).total_seconds() < debounce_seconds:
-                log.warning(f"Error notification for {n_type} is debounced. Skipping.")
+                log.warning(f"Notification for {n_type} is debounced. Skipping.")
                 return
             self._set_debounce_timestamp(n_type)
 
@@ -202,47 +483,108 @@ class Notifier:
                 self.send("APP_ERROR", "[UPS] CRITICAL: Email Sending Failed",
                           f"The UPS server failed to send an email notification. Error: {e}")
 
-    def _get_debounce_timestamp(self, n_type):
+    def _debounce_seconds(self, n_type):
+        """Minimum seconds between two notifications of n_type (0 = never debounced)."""
+        default = DEFAULT_DEBOUNCE_SECONDS.get(n_type, 0)
+        try:
+            return int(self.config.get(f"DEBOUNCE_{n_type.upper()}_SECONDS", default))
+        except ValueError:
+            return default
+
+    def _load_debounce_state(self):
+        """Load the last-sent timestamps, {n_type: unix_time}, from the debounce file."""
         try:
             with open(self.debounce_file, 'r') as f:
-                for line in f:
-                    if line.startswith(f"{n_type}_LAST_SENT="):
-                        timestamp_str = line.strip().split('=')[1]
-                        return datetime.fromtimestamp(int(timestamp_str))
-        except (IOError, ValueError, IndexError):
+                content = f.read()
+        except IOError:
+            return {}
+
+        try:
+            state = json_loads(content) if content.strip() else {}
+            if isinstance(state, dict):
+                return state
+        except ValueError:
             pass
-        return None
+
+        # Older versions stored one "<n_type>_LAST_SENT=<timestamp>" line per type
+        state = {}
+        for line in content.split('\n'):
+            name, sep, value = line.strip().partition('_LAST_SENT=')
+            if sep:
+                try:
+                    state[name] = int(value)
+                except ValueError:
+                    pass
+        return state
+
+    def _get_debounce_timestamp(self, n_type):
+        try:
+            return datetime.fromtimestamp(int(self._debounce[n_type]))
+        except (KeyError, ValueError, TypeError, OverflowError, OSError):
+            return None
 
     def _set_debounce_timestamp(self, n_type):
+        self._debounce[n_type] = int(datetime.now().timestamp())
+        # Only the power_manager instance holding LOCK_FILE writes this file,
+        # so replacing it whole needs no flock of its own
         try:
-            # Use file locking for safe concurrent access
-            with open(self.debounce_file, 'r+') as f:
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                lines = [l for l in f if not l.startswith(f"{n_type}_LAST_SENT=")]
-                lines.append(f"{n_type}_LAST_SENT={int(datetime.now().timestamp())}\n")
-                f.seek(0)
-                f.truncate()
-                f.writelines(lines)
+            write_file_atomic(self.debounce_file, json_dumps(self._debounce))
         except IOError as e:
             log.error(f"Could not update debounce timestamp file: {e}")
 
     def _send_email(self, subject, body):
-        smtp_server = self.config.get('SMTP_SERVER')
-        smtp_port = int(self.config.get('SMTP_PORT', 587))
-        smtp_user = self.config.get('SMTP_USER')
-        smtp_password = self.config.get('SMTP_PASSWORD')
-        sender_name = self.config.get('SMTP_SENDER_NAME', 'UPS Server')
-        sender_email = self.config.get('SMTP_SENDER_EMAIL')
-        recipients = [e.strip() for e in self.config.get('SMTP_RECIPIENTS', '').split(',') if e.strip()]
-        smtp_use_tls = self.config.get('SMTP_USE_TLS', 'auto').lower()  # New option
-
-        if not all([smtp_server, sender_email, recipients]):
-            raise ValueError("SMTP server, sender email, and recipients must be configured.")
+        # Imported here: most runs send no mail, and smtplib/email pull in
+        # ssl, base64 and the MIME machinery at every cron start otherwise
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.utils import formataddr
+
+        if self._smtp_settings is None:
+            smtp_server = self.config.get('SMTP_SERVER')
+            smtp_port = int(self.config.get('SMTP_PORT', 587))
+            smtp_user = self.config.get('SMTP_USER')
+            smtp_password = self.config.get('SMTP_PASSWORD')
+            sender_name = self.config.get('SMTP_SENDER_NAME', 'UPS Server')
+            sender_email = self.config.get('SMTP_SENDER_EMAIL')
+            recipients = [e.strip() for e in self.config.get('SMTP_RECIPIENTS', '').split(',') if e.strip()]
+            smtp_use_tls = self.config.get('SMTP_USE_TLS', 'auto').lower()  # New option
+
+            if not all([smtp_server, sender_email, recipients]):
+                raise ValueError("SMTP server, sender email, and recipients must be configured.")
+
+            # Parsed once per Notifier; the header values are the same for every mail
+            self._smtp_settings = (smtp_server, smtp_port, smtp_user, smtp_password, smtp_use_tls,
+                                   sender_email, recipients,
+                                   formataddr((sender_name, sender_email)), ', '.join(recipients))
+
+        (smtp_server, smtp_port, smtp_user, smtp_password, smtp_use_tls,
+         sender_email, recipients, from_header, to_header) = self._smtp_settings
 
         msg = MIMEText(body, 'plain', 'utf-8')
         msg['Subject'] = subject
-        msg['From'] = formataddr((sender_name, sender_email))
-        msg['To'] = ', '.join(recipients)
+        msg['From'] = from_header
+        msg['To'] = to_header
+
+        message = msg.as_string()
+        reused = self._server is not None
+        if not reused:
+            self._server = self._connect(smtp_server, smtp_port, smtp_use_tls, smtp_user, smtp_password)
+
+        try:
+            self._server.sendmail(sender_email, recipients, message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout):
+            # Only a dropped connection is retried; SMTPException subclasses
+            # OSError, so refusals and data errors must not be caught here
+            self.close()
+            if not reused:
+                raise
+            # The pooled connection went stale (e.g. server idle timeout): reconnect once
+            self._server = self._connect(smtp_server, smtp_port, smtp_use_tls, smtp_user, smtp_password)
+            self._server.sendmail(sender_email, recipients, message)
+
+    def _connect(self, smtp_server, smtp_port, smtp_use_tls, smtp_user, smtp_password):
+        """Open and authenticate an SMTP connection for reuse by _send_email."""
+        import smtplib
 
         server = None
         try:
@@ -268,20 +610,38 @@ class Notifier:
             
             if smtp_user and smtp_password:
                 server.login(smtp_user, smtp_password)
-            
-            server.sendmail(sender_email, recipients, msg.as_string())
-            
-        finally:
+
+            return server
+
+        except Exception:
             if server:
                 try:
                     server.quit()
                 except:
                     pass
+            raise
+
+    def close(self):
+        """Close the pooled SMTP connection, if one was opened."""
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except:
+                pass
+            self._server = None
 
 class PowerManager:
     """Main application logic with improved error handling and file locking."""
+
+    # STATE_FILE keys -> (attribute, parser for the stored value)
+    _STATE_FIELDS = {
+        'STATE': ('power_state', str),
+        'TIMESTAMP': ('power_state_timestamp', int),
+        'SIMULATION': ('power_state_was_simulation', _parse_bool),
+        'SIM_INTERRUPTED': ('simulation_interrupted', _parse_bool),
+        'INTERRUPTED_SCHEDULE': ('interrupted_schedule_info', _parse_optional_json),
+    }
     def __init__(self):
-        global log
         try:
             self.config, self.wake_hosts, self.schedules = read_power_manager_config()
         except (FileNotFoundError, IOError) as e:
@@ -291,89 +651,167 @@ class PowerManager:
         # Reconfigure logger based on DEBUG_MODE setting
         debug_mode = self.config.get('DEBUG_MODE', 'false').lower() == 'true'
         if debug_mode:
-            # Clear existing handlers and reconfigure with debug mode
-            logger = logging.getLogger(APP_NAME)
-            logger.handlers.clear()
-            log = setup_logging(debug_mode=True)
+            # Raise the existing handlers to debug level instead of reopening them
+            set_debug_logging(True)
             log.info("Debug mode enabled via configuration")
 
+        # Settings read on every iteration, parsed once per PowerManager
+        self.simulation_mode = self.config.get('POWER_SIMULATION_MODE', 'false').lower() == 'true'
+        self.sentinel_hosts = self.config.get('SENTINEL_HOSTS', '').split()
+        self._index_wake_hosts()
+        self._index_wol_hosts()
+        self._index_schedules()
         self.notifier = Notifier(self.config)
+        self._reset_run_state()
+
+    def _reset_run_state(self):
+        """Reset the state loaded from files, so a reused instance starts each run fresh."""
         self.power_state = None
         self.power_state_timestamp = None
         self.power_state_was_simulation = False
         self.simulation_interrupted = False
         self.interrupted_schedule_info = None
         self.client_notification_states = {}
+        # Last known content of files rewritten every iteration, by path
+        self._file_contents = {}
+        # Client status updates waiting to be written to CLIENT_STATUS_FILE
+        self._client_status_updates = {}
+
+    def _index_wake_hosts(self):
+        """Precompute the per-client values _check_client_statuses needs.
+
+        Builds (ip, name, shutdown_flag, stale_flag) for every wake host that
+        reports shutdowns, so the per-iteration check does no string work.
+        """
+        self._shutdown_clients = []
+        for params in self.wake_hosts.values():
+            ip = params.get('IP')
+            if 'SHUTDOWN_DELAY_MINUTES' not in params or not ip:
+                continue
+            flag_suffix = ip.replace('.', '_')
+            self._shutdown_clients.append((ip, params.get('NAME', 'N/A'),
+                                           f"SHUTDOWN_NOTIFIED_{flag_suffix}",
+                                           f"STALE_NOTIFIED_{flag_suffix}"))
+
+    def _index_wol_hosts(self):
+        """Precompute the per-host values _initiate_wol needs.
+
+        Builds (name, ip, mac, broadcast, ignore_simulation) for every wake
+        host with AUTO_WOL enabled, so the flags are parsed once per config.
+        """
+        default_broadcast = self.config.get('DEFAULT_BROADCAST_IP')
+        self._wol_hosts = []
+        for params in self.wake_hosts.values():
+            if params.get('AUTO_WOL', 'true').lower() == 'false':
+                continue
+            self._wol_hosts.append((
+                params.get('NAME'), params.get('IP'), params.get('MAC'),
+                params.get('BROADCAST_IP', default_broadcast) or WOL_DEFAULT_BROADCAST,
+                params.get('IGNORE_SIMULATION', 'false').lower() == 'true'))
+
+    def _index_schedules(self):
+        """Index schedules for _check_schedules and _find_corresponding_stop_schedule.
+
+        Groups schedule sections by their TIME, in config order, so only the
+        schedules of the current minute are examined. For stop schedules,
+        keeps the first TIME per DATE and per (TYPE, DAY_OF_WEEK), the same
+        entry the former scan over all schedules returned.
+        """
+        self._schedules_by_time = {}
+        self._stop_time_by_date = {}
+        self._stop_time_by_day = {}
+        for section, params in self.schedules.items():
+            self._schedules_by_time.setdefault(params.get('TIME'), []).append(section)
+            if params.get('ACTION', '').lower() != 'stop':
+                continue
+            if params.get('DATE'):
+                self._stop_time_by_date.setdefault(params['DATE'], params.get('TIME'))
+            self._stop_time_by_day.setdefault((params.get('TYPE'), params.get('DAY_OF_WEEK')),
+                                              params.get('TIME'))
+
+    def _set_simulation_mode(self, enabled):
+        """Persist POWER_SIMULATION_MODE and update the in-memory copies."""
+        value = 'true' if enabled else 'false'
+        save_setting_to_config('POWER_SIMULATION_MODE', value)
+        self.config['POWER_SIMULATION_MODE'] = value  # Update local config
+        self.simulation_mode = enabled
+
+    def _write_file_if_changed(self, filepath, content):
+        """Write content to filepath unless the file already holds exactly that."""
+        known = self._file_contents.get(filepath)
+        if known is None:
+            try:
+                with open(filepath, 'r') as f:
+                    known = f.read()
+            except (IOError, UnicodeDecodeError):
+                known = None
+        if known == content:
+            return
+        write_file_atomic(filepath, content)
+        self._file_contents[filepath] = content
 
     def _load_state(self):
         """Safely load state from files with comprehensive error handling."""
-        if os.path.exists(STATE_FILE):
-            try:
-                with open(STATE_FILE, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if '=' in line:
-                            try:
-                                key, value = line.split('=', 1)
-                                if key == 'STATE':
-                                    self.power_state = value
-                                elif key == 'TIMESTAMP':
-                                    self.power_state_timestamp = int(value)
-                                elif key == 'SIMULATION':
-                                    self.power_state_was_simulation = value.lower() == 'true'
-                                elif key == 'SIM_INTERRUPTED':
-                                    self.simulation_interrupted = value.lower() == 'true'
-                                    if self.simulation_interrupted:
-                                        log.debug(f"Loaded simulation_interrupted flag: {self.simulation_interrupted}")
-                                elif key == 'INTERRUPTED_SCHEDULE':
-                                    try:
-                                        self.interrupted_schedule_info = json.loads(value) if value and value != 'null' else None
-                                        if self.interrupted_schedule_info:
-                                            log.debug(f"Loaded interrupted_schedule_info: {self.interrupted_schedule_info}")
-                                    except json.JSONDecodeError as e:
-                                        log.error(f"Failed to parse INTERRUPTED_SCHEDULE JSON: {value} - {e}")
-                                        self.interrupted_schedule_info = None
-                            except (ValueError, TypeError) as e:
-                                log.warning(f"Invalid state file line: {line} - {e}")
-            except IOError as e:
-                log.error(f"Cannot read state file: {e}")
+        try:
+            with open(STATE_FILE, 'r') as f:
+                content = f.read()
+            self._file_contents[STATE_FILE] = content
+            for line in content.split('\n'):
+                line = line.strip()
+                key, sep, value = line.partition('=')
+                field = self._STATE_FIELDS.get(key) if sep else None
+                if field is None:
+                    continue
+                attr, parse = field
+                try:
+                    setattr(self, attr, parse(value))
+                except json.JSONDecodeError as e:
+                    log.error(f"Failed to parse {key} JSON: {value} - {e}")
+                    setattr(self, attr, None)
+                except (ValueError, TypeError) as e:
+                    log.warning(f"Invalid state file line: {line} - {e}")
+            if self.simulation_interrupted:
+                log.debug(f"Loaded simulation_interrupted flag: {self.simulation_interrupted}")
+            if self.interrupted_schedule_info:
+                log.debug(f"Loaded interrupted_schedule_info: {self.interrupted_schedule_info}")
+        except FileNotFoundError:
+            pass
+        except IOError as e:
+            log.error(f"Cannot read state file: {e}")
         
-        if os.path.exists(CLIENT_NOTIFICATION_STATE_FILE):
-            try:
-                with open(CLIENT_NOTIFICATION_STATE_FILE, 'r') as f:
-                    for line in f:
-                        line = line.strip()
-                        if '=' in line:
-                            try:
-                                key, value = line.split('=', 1)
-                                self.client_notification_states[key] = value.lower() == 'true'
-                            except ValueError as e:
-                                log.warning(f"Invalid client notification state line: {line} - {e}")
-            except IOError as e:
-                log.error(f"Cannot read client notification state file: {e}")
-
-    def _save_power_state(self, state):
-        """Safely save power state with file locking."""
         try:
-            with open(STATE_FILE, 'w') as f:
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                f.write(f"STATE={state}\n")
-                f.write(f"TIMESTAMP={int(datetime.now().timestamp())}\n")
-                # Save simulation mode status for restoration logic
-                is_simulation = self.config.get('POWER_SIMULATION_MODE', 'false').lower() == 'true'
-                f.write(f"SIMULATION={str(is_simulation).lower()}\n")
-                f.write(f"SIM_INTERRUPTED={str(self.simulation_interrupted).lower()}\n")
-                schedule_json = json.dumps(self.interrupted_schedule_info) if self.interrupted_schedule_info else 'null'
-                f.write(f"INTERRUPTED_SCHEDULE={schedule_json}\n")
+            with open(CLIENT_NOTIFICATION_STATE_FILE, 'r') as f:
+                content = f.read()
+            self._file_contents[CLIENT_NOTIFICATION_STATE_FILE] = content
+            for line in content.split('\n'):
+                key, sep, value = line.strip().partition('=')
+                if sep:
+                    self.client_notification_states[key] = value.lower() == 'true'
+        except FileNotFoundError:
+            pass
+        except IOError as e:
+            log.error(f"Cannot read client notification state file: {e}")
+
+    def _save_power_state(self, state, now):
+        """Safely save power state, replacing the state file atomically when it changed."""
+        # Save simulation mode status for restoration logic
+        is_simulation = self.simulation_mode
+        schedule_json = json_dumps(self.interrupted_schedule_info).decode('utf-8') if self.interrupted_schedule_info else 'null'
+        content = (f"STATE={state}\n"
+                   f"TIMESTAMP={int(now.timestamp())}\n"
+                   f"SIMULATION={str(is_simulation).lower()}\n"
+                   f"SIM_INTERRUPTED={str(self.simulation_interrupted).lower()}\n"
+                   f"INTERRUPTED_SCHEDULE={schedule_json}\n")
+        try:
+            self._write_file_if_changed(STATE_FILE, content)
         except IOError as e:
             log.error(f"Cannot save power state: {e}")
 
     def _clear_file(self, filepath):
-        """Safely clear and recreate a file."""
+        """Safely clear a file, creating it if missing (a single open with O_TRUNC)."""
         try:
-            if os.path.exists(filepath):
-                os.remove(filepath)
-            open(filepath, 'a').close()
+            os.close(os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666))
+            self._file_contents[filepath] = ''
         except IOError as e:
             log.error(f"Cannot clear file {filepath}: {e}")
 
@@ -381,49 +819,48 @@ class PowerManager:
         """Update UPS status file with error handling."""
         ups_file = self.config.get('UPS_STATE_FILE', UPS_STATE_FILE_DEFAULT)
         try:
-            with open(ups_file, 'w') as f:
-                f.write(status_line + '\n')
+            # Unchanged status is not rewritten, so the UPS driver only sees real changes
+            self._write_file_if_changed(ups_file, status_line + '\n')
         except IOError as e:
             log.error(f"Cannot update UPS status file: {e}")
 
-    def _should_simulation_be_active_now(self):
+    def _should_simulation_be_active_now(self, now):
         """Check if any schedule indicates simulation should be active at current time.
         NOTE: This function checks time windows regardless of ENABLED flag,
         because one-time schedules are auto-disabled after execution.
         """
-        now = datetime.now()
-
+        today, current_time = now.strftime('%Y-%m-%d'), now.strftime('%H:%M')
+        weekday = now.strftime('%A').lower()
         for section, params in self.schedules.items():
             # Note: We don't check ENABLED here because one-time schedules
             # are automatically disabled after execution, but their time window
             # is still active until the corresponding stop schedule.
 
+            if params.get('ACTION', '').lower() != 'start':  # Only check start schedules
+                continue
+
             schedule_type = params.get('TYPE', '').lower()
             schedule_time = params.get('TIME', '')
-            action = params.get('ACTION', '').lower()
-
-            if action != 'start':  # Only check start schedules
-                continue
 
             # For one-time schedules, check if today matches and time has passed
             if schedule_type == 'one-time':
                 schedule_date = params.get('DATE', '')
-                if schedule_date == now.strftime('%Y-%m-%d'):
-                    if schedule_time <= now.strftime('%H:%M'):
+                if schedule_date == today:
+                    if schedule_time <= current_time:
                         # Check if there's a corresponding stop schedule
                         stop_time = self._find_corresponding_stop_schedule(section, schedule_date)
-                        if stop_time and now.strftime('%H:%M') < stop_time:
+                        if stop_time and current_time < stop_time:
                             return {'active': True, 'schedule': section, 'params': params, 'end_time': stop_time}
 
             # For recurring schedules
             elif schedule_type == 'recurring':
                 dow = params.get('DAY_OF_WEEK', '').lower()
-                if dow == 'everyday' or dow == now.strftime('%A').lower():
-                    if schedule_time <= now.strftime('%H:%M'):
+                if dow == 'everyday' or dow == weekday:
+                    if schedule_time <= current_time:
                         # For recurring, assume it runs until end of day unless stopped
                         stop_time = self._find_corresponding_stop_schedule(section)
-                        end_time = stop_time if stop_time and stop_time > now.strftime('%H:%M') else '23:59'
-                        if now.strftime('%H:%M') < end_time:
+                        end_time = stop_time if stop_time and stop_time > current_time else '23:59'
+                        if current_time < end_time:
                             return {'active': True, 'schedule': section, 'params': params, 'end_time': end_time}
 
         return {'active': False}
@@ -432,33 +869,30 @@ class PowerManager:
         """Find corresponding stop schedule for a start schedule.
         NOTE: Does not check ENABLED flag for same reason as _should_simulation_be_active_now.
         """
-        for section, params in self.schedules.items():
-            if params.get('ACTION', '').lower() == 'stop':
-
-                if date:  # One-time schedule
-                    if params.get('DATE') == date:
-                        return params.get('TIME')
-                else:  # Recurring schedule
-                    # Simple heuristic: find stop on same day type
-                    start_params = self.schedules.get(start_section, {})
-                    if (params.get('TYPE') == start_params.get('TYPE') and
-                        params.get('DAY_OF_WEEK') == start_params.get('DAY_OF_WEEK')):
-                        return params.get('TIME')
-        return None
+        if date:  # One-time schedule
+            return self._stop_time_by_date.get(date)
 
-    def _check_schedules(self):
+        # Recurring schedule - simple heuristic: find stop on same day type
+        start_params = self.schedules.get(start_section, {})
+        return self._stop_time_by_day.get((start_params.get('TYPE'), start_params.get('DAY_OF_WEEK')))
+
+    def _check_schedules(self, now):
         """Check and execute scheduled actions."""
-        now = datetime.now()
-        for section, params in self.schedules.items():
+        today, current_time = now.strftime('%Y-%m-%d'), now.strftime('%H:%M')
+        weekday = now.strftime('%A').lower()
+        # Every schedule type fires only in its exact minute
+        for section in self._schedules_by_time.get(current_time, ()):
+            params = self.schedules[section]
             if params.get('ENABLED', 'false').lower() != 'true': 
                 continue
 
+            schedule_type = params.get('TYPE')
             match = False
-            if params.get('TYPE') == 'one-time' and params.get('DATE') == now.strftime('%Y-%m-%d') and params.get('TIME') == now.strftime('%H:%M'):
+            if schedule_type == 'one-time' and params.get('DATE') == today:
                 match = True
-            elif params.get('TYPE') == 'recurring' and params.get('TIME') == now.strftime('%H:%M'):
+            elif schedule_type == 'recurring':
                 dow = params.get('DAY_OF_WEEK', '').lower()
-                if dow == 'everyday' or dow == now.strftime('%A').lower():
+                if dow == 'everyday' or dow == weekday:
                     match = True
             
             if match:
@@ -467,48 +901,47 @@ class PowerManager:
                 
                 try:
                     if action == 'start':
-                        save_setting_to_config('POWER_SIMULATION_MODE', 'true')
+                        self._set_simulation_mode(True)
                         self.notifier.send("SIMULATION_MODE", "[UPS] INFO: Power Outage Simulation Started", "Scheduled start of power outage simulation.")
                     elif action == 'stop':
-                        save_setting_to_config('POWER_SIMULATION_MODE', 'false')
+                        self._set_simulation_mode(False)
                         self.notifier.send("SIMULATION_MODE", "[UPS] INFO: Power Outage Simulation Stopped", "Scheduled stop of power outage simulation.")
                     
-                    if params.get('TYPE') == 'one-time':
+                    if schedule_type == 'one-time':
                         save_setting_to_config('ENABLED', 'false', section=section)
-                    
-                    # Reload config after changes
-                    self.config, self.wake_hosts, self.schedules = read_power_manager_config()
+                        params['ENABLED'] = 'false'  # Update local schedule
                     
                 except Exception as e:
                     log.error(f"Failed to execute scheduled action: {e}")
                 
                 break
 
-    def _determine_power_status(self):
+    def _determine_power_status(self, now):
         """Determine current power status with improved error handling and simulation interruption detection."""
-        is_simulation_mode = self.config.get('POWER_SIMULATION_MODE', 'false').lower() == 'true'
+        is_simulation_mode = self.simulation_mode
 
         # Always check sentinel hosts to detect real power failures
-        sentinel_hosts = self.config.get('SENTINEL_HOSTS', '').split()
+        sentinel_hosts = self.sentinel_hosts
         if not sentinel_hosts:
             log.warning("No sentinel hosts configured, assuming power is ONLINE")
             return "ONLINE"
 
         log.info(f"Pinging sentinel hosts: {' '.join(sentinel_hosts)}")
-        online_hosts_count = 0
 
-        # Check ALL sentinel hosts (matching original Bash behavior)
+        # Ping all sentinel hosts at once; one reply is enough to know power is on.
+        # In debug mode wait for every host, so the log shows each one's state.
+        results = ping_hosts(sentinel_hosts, stop_on_first=not log.isEnabledFor(logging.DEBUG))
         for ip in sentinel_hosts:
-            try:
-                result = subprocess.run([PING_CMD, "-c", "1", "-W", "1", ip],
-                                      capture_output=True, timeout=3)
-                if result.returncode == 0:
-                    log.info(f"  -> Sentinel host {ip} is online.")
-                    online_hosts_count += 1
-                else:
-                    log.info(f"  -> Sentinel host {ip} is offline.")
-            except (subprocess.TimeoutExpired, OSError) as e:
-                log.warning(f"  -> Failed to ping sentinel host {ip}: {e}")
+            if ip not in results:
+                continue
+            reachable = results[ip]
+            if reachable:
+                log.info(f"  -> Sentinel host {ip} is online.")
+            elif reachable is False:
+                log.info(f"  -> Sentinel host {ip} is offline.")
+            else:
+                log.warning(f"  -> Failed to ping sentinel host {ip}.")
+        online_hosts_count = sum(1 for reachable in results.values() if reachable)
 
         log.info(f"Found {online_hosts_count} online sentinel hosts.")
 
@@ -519,14 +952,14 @@ class PowerManager:
             log.critical("REAL POWER FAILURE detected during simulation! Interrupting simulation mode.")
 
             # Save information about interrupted simulation
-            sim_info = self._should_simulation_be_active_now()
+            sim_info = self._should_simulation_be_active_now(now)
             log.debug(f"Simulation schedule check result: {sim_info}")
             if sim_info['active']:
                 self.simulation_interrupted = True
                 self.interrupted_schedule_info = {
                     'schedule': sim_info['schedule'],
                     'end_time': sim_info['end_time'],
-                    'interrupted_at': datetime.now().strftime('%Y-%m-%d %H:%M')
+                    'interrupted_at': now.strftime('%Y-%m-%d %H:%M')
                 }
                 log.debug(f"Set simulation_interrupted=True, interrupted_schedule_info={self.interrupted_schedule_info}")
             else:
@@ -534,8 +967,7 @@ class PowerManager:
 
             # Turn off simulation mode immediately
             try:
-                save_setting_to_config('POWER_SIMULATION_MODE', 'false')
-                self.config['POWER_SIMULATION_MODE'] = 'false'  # Update local config
+                self._set_simulation_mode(False)
                 log.info("Simulation mode disabled due to real power failure.")
             except Exception as e:
                 log.error(f"Failed to disable simulation mode: {e}")
@@ -553,7 +985,7 @@ class PowerManager:
             log.info("At least one sentinel host is online. Power is ON.")
             return "ONLINE"
 
-    def _handle_power_offline(self):
+    def _handle_power_offline(self, now):
         """Handle power offline state."""
         state_changed = self.power_state != "POWER_FAIL"
 
@@ -565,9 +997,7 @@ class PowerManager:
             self.client_notification_states = {}
 
             # Check if this is a real power failure or simulation
-            is_simulation = self.config.get('POWER_SIMULATION_MODE', 'false').lower() == 'true'
-
-            if is_simulation:
+            if self.simulation_mode:
                 # In simulation mode, send simulation notification instead of power fail
                 self.notifier.send("SIMULATION_MODE", "[UPS] INFO: Power Outage Simulation Active",
                                  "Power outage simulation is active. UPS status set to 'On Battery, Low Battery' for testing.")
@@ -581,7 +1011,7 @@ class PowerManager:
         log.debug(f"Should save state: {should_save} (state_changed={state_changed}, simulation_interrupted={self.simulation_interrupted})")
 
         if should_save:
-            self._save_power_state("POWER_FAIL")
+            self._save_power_state("POWER_FAIL", now)
             if self.simulation_interrupted and not state_changed:
                 log.debug("Saving state to persist simulation interruption flags.")
             if self.simulation_interrupted:
@@ -589,13 +1019,13 @@ class PowerManager:
 
         self._update_ups_status_file("ups.status: OB LB")
 
-    def _handle_power_online(self):
+    def _handle_power_online(self, now):
         """Handle power online state."""
         self._update_ups_status_file("ups.status: OL")
         if not self.power_state: 
             return
 
-        now_ts = int(datetime.now().timestamp())
+        now_ts = int(now.timestamp())
         wol_delay = int(self.config.get('WOL_DELAY_MINUTES', 5))
         
         if self.power_state == "POWER_FAIL":
@@ -610,14 +1040,13 @@ class PowerManager:
 
                 # Check if we should restore simulation mode
                 if self.interrupted_schedule_info:
-                    current_time = datetime.now().strftime('%H:%M')
+                    current_time = now.strftime('%H:%M')
                     end_time = self.interrupted_schedule_info.get('end_time', '23:59')
 
                     if current_time < end_time:
                         log.info(f"Restoring simulation mode until {end_time}")
                         try:
-                            save_setting_to_config('POWER_SIMULATION_MODE', 'true')
-                            self.config['POWER_SIMULATION_MODE'] = 'true'  # Update local config
+                            self._set_simulation_mode(True)
                             self.notifier.send("SIMULATION_MODE", "[UPS] INFO: Simulation Restored After Power Failure",
                                              f"Power restored during scheduled simulation window. Resuming simulation until {end_time}.")
 
@@ -632,7 +1061,7 @@ class PowerManager:
 
                 # Clear interruption flags - but keep them if we restored simulation
                 # (they will be cleared after WoL completes)
-                if self.config.get('POWER_SIMULATION_MODE', 'false').lower() != 'true':
+                if not self.simulation_mode:
                     self.simulation_interrupted = False
                     self.interrupted_schedule_info = None
 
@@ -646,11 +1075,11 @@ class PowerManager:
                                  f"Power restored after ~{duration} mins. Waiting {wol_delay} mins for WoL.")
 
             # Save state - use special state if we restored simulation mode
-            if self.config.get('POWER_SIMULATION_MODE', 'false').lower() == 'true' and self.simulation_interrupted:
-                self._save_power_state("POWER_RESTORED_SIM")
+            if self.simulation_mode and self.simulation_interrupted:
+                self._save_power_state("POWER_RESTORED_SIM", now)
                 log.debug("Saved state as POWER_RESTORED_SIM (simulation restored after interruption)")
             else:
-                self._save_power_state("POWER_RESTORED")
+                self._save_power_state("POWER_RESTORED", now)
 
         elif self.power_state == "POWER_RESTORED":
             if self.power_state_timestamp and (now_ts - self.power_state_timestamp) >= (wol_delay * 60):
@@ -678,120 +1107,124 @@ class PowerManager:
 
     def _initiate_wol(self):
         """Initiate Wake-on-LAN sequence with comprehensive error handling and status tracking."""
-        default_broadcast = self.config.get('DEFAULT_BROADCAST_IP')
         woken_hosts = []
 
         # Check if we're currently in simulation mode
-        is_simulation_active = self.config.get('POWER_SIMULATION_MODE', 'false').lower() == 'true'
+        is_simulation_active = self.simulation_mode
         if is_simulation_active:
             log.info("Simulation mode is active - will only wake hosts with IGNORE_SIMULATION=true")
 
-        for section, params in self.wake_hosts.items():
-            if params.get('AUTO_WOL', 'true').lower() == 'false':
-                continue
-
+        targets = []
+        for name, ip, mac, broadcast, ignore_simulation in self._wol_hosts:
             # If simulation is active, only wake hosts that ignore simulation
-            if is_simulation_active:
-                ignore_simulation = params.get('IGNORE_SIMULATION', 'false').lower() == 'true'
-                if not ignore_simulation:
-                    log.info(f"Skipping WoL for {params.get('NAME', 'unknown')} ({params.get('IP')}) - simulation mode active and host does not ignore simulation")
-                    continue
+            if is_simulation_active and not ignore_simulation:
+                log.info(f"Skipping WoL for {name or 'unknown'} ({ip}) - simulation mode active and host does not ignore simulation")
+                continue
 
-            ip, mac = params.get('IP'), params.get('MAC')
             if not ip or not mac:
-                log.warning(f"Skipping WoL for {params.get('NAME', 'unknown')} - missing IP or MAC")
+                log.warning(f"Skipping WoL for {name or 'unknown'} - missing IP or MAC")
                 continue
 
-            try:
-                # Check if host is already online
-                ping_result = subprocess.run([PING_CMD, "-c", "1", "-W", "1", ip], 
-                                           capture_output=True, timeout=3)
-                
-                if ping_result.returncode != 0:
-                    broadcast = params.get('BROADCAST_IP', default_broadcast)
-                    log.info(f"Sending WoL to {params.get('NAME')} ({ip}) via {broadcast}.")
-                    
-                    # Send WoL packet and check result (improved from original)
-                    wol_result = subprocess.run([WAKEONLAN_CMD, "-i", broadcast, mac], 
-                                              capture_output=True, timeout=5)
-                    
-                    if wol_result.returncode == 0:
-                        self._update_client_status_json(ip, "wol_sent")
-                        woken_hosts.append(f"- {params.get('NAME')} ({ip})")
-                        log.info(f"WoL packet sent successfully to {params.get('NAME')} ({ip})")
-                    else:
-                        log.error(f"Failed to send WoL packet to {params.get('NAME')} ({ip}): {wol_result.stderr.decode()}")
-                        self._update_client_status_json(ip, "wol_failed")
-                else:
-                    log.info(f"Host {params.get('NAME')} ({ip}) is already online.")
-                    
-            except (subprocess.TimeoutExpired, OSError) as e:
-                log.error(f"Error during WoL process for {params.get('NAME')} ({ip}): {e}")
-                self._update_client_status_json(ip, "wol_error")
+            targets.append((name, ip, mac, broadcast))
+
+        if not targets:
+            return
+
+        # Check which hosts are already online, pinging them all at once
+        ping_results = ping_hosts([ip for _, ip, _, _ in targets])
+        # One status timestamp for the whole batch, in the format the Web GUI expects
+        timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        # All magic packets go out through one broadcast-enabled UDP socket
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as wol_socket:
+            wol_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+            for name, ip, mac, broadcast in targets:
+                reachable = ping_results.get(ip)
+                if reachable is None:
+                    log.error(f"Error during WoL process for {name} ({ip}): ping did not complete")
+                    self._update_client_status_json(ip, "wol_error", timestamp)
+                    continue
+                if reachable:
+                    log.info(f"Host {name} ({ip}) is already online.")
+                    continue
+
+                log.info(f"Sending WoL to {name} ({ip}) via {broadcast}.")
+                try:
+                    wol_socket.sendto(build_magic_packet(mac), (broadcast, WOL_PORT))
+                    self._update_client_status_json(ip, "wol_sent", timestamp)
+                    woken_hosts.append(f"- {name} ({ip})")
+                    log.info(f"WoL packet sent successfully to {name} ({ip})")
+                except ValueError as e:
+                    log.error(f"Failed to send WoL packet to {name} ({ip}): {e}")
+                    self._update_client_status_json(ip, "wol_failed", timestamp)
+                except OSError as e:
+                    log.error(f"Error during WoL process for {name} ({ip}): {e}")
+                    self._update_client_status_json(ip, "wol_error", timestamp)
 
         if woken_hosts:
             self.notifier.send("POWER_RESTORED", "[UPS] INFO: WoL Sequence Initiated",
                                "Sent WoL signals to:\n\n" + "\n".join(woken_hosts))
 
-    def _update_client_status_json(self, ip, status):
-        """Update client status JSON with atomic writes and compatible format."""
+    def _update_client_status_json(self, ip, status, timestamp):
+        """Queue a client status update; _flush_client_statuses() writes it out."""
+        self._client_status_updates[ip] = {
+            "status": status, 
+            "timestamp": timestamp,
+            "remaining_seconds": None,
+            "shutdown_delay": None
+        }
+
+    def _flush_client_statuses(self):
+        """Merge queued client status updates into the JSON file in one atomic write.
+
+        The file is re-read right before writing because the API workers
+        update it concurrently; only the queued clients are overwritten.
+        """
+        if not self._client_status_updates:
+            return
+
         statuses = {}
-        
         try:
-            if os.path.exists(CLIENT_STATUS_FILE):
-                with open(CLIENT_STATUS_FILE, 'r') as f: 
-                    statuses = json.load(f)
+            statuses = dict(_read_client_statuses())
+        except FileNotFoundError:
+            pass
         except (IOError, json.JSONDecodeError) as e:
             log.warning(f"Failed to read client status file: {e}")
 
+        statuses.update(self._client_status_updates)
+        self._client_status_updates = {}
         try:
-            # Use timestamp format compatible with Web GUI expectations
-            timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
-            statuses[ip] = {
-                "status": status, 
-                "timestamp": timestamp,
-                "remaining_seconds": None,
-                "shutdown_delay": None
-            }
-            
-            # Use atomic write operation
-            temp_file = CLIENT_STATUS_FILE + ".tmp"
-            with open(temp_file, 'w') as f: 
-                json.dump(statuses, f, indent=2)
-            os.rename(temp_file, CLIENT_STATUS_FILE)
-                
-        except (IOError, json.JSONDecodeError) as e:
+            write_file_atomic(CLIENT_STATUS_FILE, json_dumps(statuses))
+        except IOError as e:
             log.error(f"Failed to update client status file: {e}")
 
-    def _check_client_statuses(self):
+    def _check_client_statuses(self, utc_now):
         """Check client statuses and send notifications with improved error handling."""
-        if not os.path.exists(CLIENT_STATUS_FILE): 
+        # Nothing to check unless some wake host reports shutdowns
+        if not self._shutdown_clients: 
             return
             
         try:
-            with open(CLIENT_STATUS_FILE, 'r') as f: 
-                client_statuses = json.load(f)
+            client_statuses = _read_client_statuses()
+        except FileNotFoundError:
+            return
         except (IOError, json.JSONDecodeError) as e:
             log.error(f"Failed to parse client status file: {e}")
             return
+        if not client_statuses:
+            return
 
-        now = datetime.utcnow()
         stale_minutes = int(self.config.get('CLIENT_STALE_TIMEOUT_MINUTES', 5))
+        # Reports older than this are stale
+        stale_before = utc_now - timedelta(minutes=stale_minutes)
         
-        for section, params in self.wake_hosts.items():
-            if 'SHUTDOWN_DELAY_MINUTES' not in params: 
-                continue
-                
-            ip, name = params.get('IP'), params.get('NAME', 'N/A')
-            if not ip: 
-                continue
-                
+        for ip, name, shutdown_flag, stale_flag in self._shutdown_clients:
             status_data = client_statuses.get(ip)
             if not status_data: 
                 continue
 
             # Check for shutdown notification
-            shutdown_flag = f"SHUTDOWN_NOTIFIED_{ip.replace('.', '_')}"
             if (status_data.get('status') == 'shutdown_pending' and 
                 not self.client_notification_states.get(shutdown_flag)):
                 
@@ -800,23 +1233,10 @@ class PowerManager:
                 self.client_notification_states[shutdown_flag] = True
 
             # Check for stale status with robust timestamp parsing
-            stale_flag = f"STALE_NOTIFIED_{ip.replace('.', '_')}"
             try:
                 timestamp_str = status_data.get('timestamp', '')
                 if timestamp_str:
-                    # Handle both ISO format and RFC3339 format
-                    if timestamp_str.endswith('Z'):
-                        ts = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-                    else:
-                        ts = datetime.fromisoformat(timestamp_str)
-                    
-                    # Convert to UTC if necessary
-                    if ts.tzinfo is not None:
-                        ts = ts.replace(tzinfo=None)
-                    
-                    time_diff = (now - ts).total_seconds()
-                    
-                    if time_diff > (stale_minutes * 60):
+                    if _parse_client_timestamp(timestamp_str) < stale_before:
                         if not self.client_notification_states.get(stale_flag):
                             self.notifier.send("CLIENT_STALE", "[UPS] WARNING: Client Stale", 
                                              f"Client '{name}' ({ip}) has not reported for {stale_minutes}+ minutes.")
@@ -838,6 +1258,9 @@ class PowerManager:
         """
         log.info(f"--- Power check initiated (iteration {iteration + 1}/{CHECK_ITERATIONS}) ---")
         try:
+            # One clock reading per iteration, shared by all the checks below
+            now, utc_now = datetime.now(), datetime.utcnow()
+            self._reset_run_state()
             self._load_state()
 
             # Log current state for debugging
@@ -846,27 +1269,28 @@ class PowerManager:
 
             # Only check schedules on the first iteration to avoid duplicate triggers
             if iteration == 0:
-                self._check_schedules()
-            power_status = self._determine_power_status()
+                self._check_schedules(now)
+            power_status = self._determine_power_status(now)
 
             # Special handling for POWER_RESTORED_SIM state:
             # Even if power_status is OFFLINE (due to simulation), we need to handle WoL
             if self.power_state == "POWER_RESTORED_SIM":
                 log.debug("Current state is POWER_RESTORED_SIM - handling WoL logic despite power_status")
-                self._handle_power_online()  # This handles the POWER_RESTORED_SIM state
+                self._handle_power_online(now)  # This handles the POWER_RESTORED_SIM state
             elif power_status == "OFFLINE":
-                self._handle_power_offline()
+                self._handle_power_offline(now)
             else:
-                self._handle_power_online()
+                self._handle_power_online(now)
 
-            self._check_client_statuses()
+            # Write WoL results before the client check reads the file back
+            self._flush_client_statuses()
+            self._check_client_statuses(utc_now)
             
-            # Save client notification states with file locking
+            # Save client notification states, skipping the write when nothing changed
             try:
-                with open(CLIENT_NOTIFICATION_STATE_FILE, 'w') as f:
-                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                    for k, v in self.client_notification_states.items():
-                        f.write(f"{k}={str(v).lower()}\n")
+                content = ''.join(f"{k}={str(v).lower()}\n"
+                                  for k, v in self.client_notification_states.items())
+                self._write_file_if_changed(CLIENT_NOTIFICATION_STATE_FILE, content)
             except IOError as e:
                 log.error(f"Cannot save client notification states: {e}")
 
@@ -878,17 +1302,17 @@ class PowerManager:
             except:
                 pass  # Don't fail on notification failure
         finally:
+            self._flush_client_statuses()
+            self.notifier.close()
             log.info("--- Power check finished ---")
 
 if __name__ == "__main__":
     # Ensure required files exist with proper error handling
     for f in [STATE_FILE, NOTIFICATION_STATE_FILE, CLIENT_NOTIFICATION_STATE_FILE, CLIENT_STATUS_FILE]:
         try:
-            if not os.path.exists(f):
-                open(f, 'a').close()
-                if f.endswith('.json'):
-                    with open(f, 'w') as jf:
-                        jf.write('{}')
+            if _touch(f) and f.endswith('.json'):
+                with open(f, 'w') as jf:
+                    jf.write('{}')
         except IOError as e:
             print(f"Warning: Cannot create {f}: {e}", file=sys.stderr)
 
@@ -905,14 +1329,23 @@ if __name__ == "__main__":
         sys.exit(0)
 
     try:
+        started = time.monotonic()
+        manager, manager_config_key = None, None
         for iteration in range(CHECK_ITERATIONS):
-            # Create a fresh PowerManager for each iteration to pick up
-            # any config changes made via the Web GUI between checks
-            PowerManager().run(iteration=iteration)
-
-            # Sleep between iterations (but not after the last one)
+            # Create a new PowerManager only when the config changed (e.g. saved
+            # from the Web GUI) since the last one; otherwise reuse its parsed
+            # settings, host indexes and notifier
+            config_key = config_file_key(CONFIG_FILE)
+            if manager is None or config_key != manager_config_key:
+                manager, manager_config_key = PowerManager(), config_key
+            manager.run(iteration=iteration)
+
+            # Sleep until the next check is due (but not after the last one).
+            # Checks stay CHECK_INTERVAL_SECONDS apart from the start, so time
+            # spent on slow SMTP or pings does not push the later ones back.
             if iteration < CHECK_ITERATIONS - 1:
-                time.sleep(CHECK_INTERVAL_SECONDS)
+                next_check = started + (iteration + 1) * CHECK_INTERVAL_SECONDS
+                time.sleep(max(0, next_check - time.monotonic()))
     finally:
         # Release lock file
         if lock_fd:
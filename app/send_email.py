@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import os
 import smtplib
 import re
 from email.mime.text import MIMEText
@@ -11,24 +10,21 @@ from email.utils import formataddr
 # --- Configuration ---
 POWER_MANAGER_CONFIG = "/etc/nut/power_manager.conf"
 
+# A key=value line of power_manager.conf (groups 1 and 2). Comments, blank
+# lines and any line containing '[' (section headers) do not match.
+_CONFIG_LINE_RE = re.compile(r'^[^\S\n]*([^\s#\[=][^\n=\[]*)?=([^\n\[]*)$', re.MULTILINE)
+
 def read_power_manager_config():
     """Read and parse power_manager.conf file to get main config."""
-    config = {}
-    if not os.path.exists(POWER_MANAGER_CONFIG):
-        return config
-    
-    with open(POWER_MANAGER_CONFIG, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#') or '[' in line:
-                continue
-            
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip()
-                value = value.strip().strip('"\'').strip()
-                config[key] = value
-    return config
+    try:
+        with open(POWER_MANAGER_CONFIG, 'r') as f:
+            content = f.read()
+    except FileNotFoundError:
+        return {}
+
+    # One regex pass over the whole file instead of a Python loop per line
+    return {key.strip() if key else '': value.strip().strip('"\'').strip()
+            for key, value in _CONFIG_LINE_RE.findall(content)}
 
 def send_email(subject, body, config):
     """Send an email using configured SMTP settings."""
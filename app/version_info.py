@@ -8,16 +8,23 @@ Description: Simple version management system inspired by SearXNG
 """
 
 import os
+import shlex
+import shutil
 import sys
 import subprocess
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 
+from common import json_dumps, json_loads
+
 # Configuration
+@lru_cache(maxsize=1)
 def get_version_file_paths():
-    """Get appropriate paths for version files based on environment."""
+    """Get appropriate paths for version files based on environment (cached per process)."""
     working_dir = get_working_directory()
     
     if working_dir == "/app":
@@ -29,12 +36,38 @@ def get_version_file_paths():
         fallback_path = os.path.join(working_dir, "app", "version_info.json") if working_dir != "./app" else "version_info.json"
         return primary_path, fallback_path
 
+# Cache of the Git lookup, stored inside .git so it never shows up as a change
+GIT_CACHE_FILE = "ups_version_cache.json"
+
+# Git commands, pre-split into argv lists
+GIT_CONFIG_CMDS = [
+    ["git", "config", "core.filemode", "false"],
+    ["git", "config", "core.autocrlf", "false"],
+    ["git", "config", "core.safecrlf", "false"],
+]
+GIT_REFRESH_CMD = ["git", "update-index", "--refresh"]
+# Short hash, commit date, ref names and subject separated by the ASCII unit separator
+GIT_COMMIT_INFO_CMD = ["git", "log", "-1", "--format=%h%x1f%ci%x1f%D%x1f%s", "HEAD"]
+GIT_EXACT_TAG_CMD = ["git", "describe", "--tags", "--exact-match", "HEAD"]
+GIT_LATEST_TAG_CMD = ["git", "describe", "--tags", "--abbrev=0"]
+# Untracked files never count as changes, so skip the untracked-file walk
+GIT_STATUS_CMD = ["git", "status", "--porcelain", "--untracked-files=no"]
+
+# git resolved on PATH once, instead of by every exec; None if not installed
+GIT_EXECUTABLE = shutil.which("git")
+
+# C locale skips message catalog loading (and keeps stderr matchable);
+# GIT_OPTIONAL_LOCKS=0 stops read-only commands from taking the index lock
+GIT_ENV = dict(os.environ, LC_ALL="C", GIT_OPTIONAL_LOCKS="0")
+
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=1)
 def get_working_directory():
     """
     Auto-detect the correct working directory for git operations.
     Works both in container (/app) and on host (./app or current dir).
+    The result is cached per process, like the version lookups below.
     """
     # Try different possible locations
     candidates = [
@@ -44,10 +77,11 @@ def get_working_directory():
         os.path.dirname(os.path.abspath(__file__))  # Directory where this script is located
     ]
     
+    # One stat per probe: a .git entry can only exist if its directory does
     for candidate in candidates:
-        if os.path.exists(candidate) and os.path.exists(os.path.join(candidate, ".git")):
+        if os.path.exists(os.path.join(candidate, ".git")):
             return os.path.abspath(candidate)
-        elif os.path.exists(candidate) and os.path.exists(os.path.join(os.path.dirname(candidate), ".git")):
+        elif os.path.exists(os.path.join(os.path.dirname(candidate), ".git")):
             # If we're in app/ subdirectory, go up one level to find .git
             return os.path.abspath(os.path.dirname(candidate))
     
@@ -55,18 +89,24 @@ def get_working_directory():
     return os.getcwd()
 
 def run_git_command(command, working_dir=None):
-    """Execute git command safely and return output."""
+    """Execute git command (argv list or command string) safely and return output."""
     if working_dir is None:
         working_dir = get_working_directory()
+    if isinstance(command, str):
+        command = shlex.split(command)
+    argv = command
+    if command[0] == "git" and GIT_EXECUTABLE:
+        argv = [GIT_EXECUTABLE] + command[1:]
     
     try:
+        # Run git directly rather than through /bin/sh
         result = subprocess.run(
-            command,
-            shell=True,
+            argv,
             capture_output=True,
             text=True,
             timeout=5,
-            cwd=working_dir
+            cwd=working_dir,
+            env=GIT_ENV
         )
         if result.returncode == 0:
             return result.stdout.strip()
@@ -74,10 +114,10 @@ def run_git_command(command, working_dir=None):
             # Don't log warnings for commands that are expected to fail as part of the logic,
             # like trying to find an exact tag.
             if "no tag" not in result.stderr.strip() and "No names found" not in result.stderr.strip():
-                logger.warning(f"Git command failed: {command} - {result.stderr.strip()}")
+                logger.warning(f"Git command failed: {' '.join(command)} - {result.stderr.strip()}")
             return None
     except (subprocess.TimeoutExpired, FileNotFoundError) as e:
-        logger.warning(f"Git command error: {command} - {str(e)}")
+        logger.warning(f"Git command error: {' '.join(command)} - {str(e)}")
         return None
 
 def check_git_dirty_status(working_dir=None):
@@ -90,7 +130,7 @@ def check_git_dirty_status(working_dir=None):
         
     try:
         # Strategy 1: Use git status --porcelain (more reliable than git diff)
-        status_output = run_git_command("git status --porcelain", working_dir)
+        status_output = run_git_command(GIT_STATUS_CMD, working_dir)
         if status_output is None:
             # Git command failed, assume clean to avoid false dirty flag
             logger.warning("Could not determine git status, assuming clean")
@@ -127,42 +167,47 @@ def check_git_dirty_status(working_dir=None):
         # On error, assume clean to avoid false dirty flag
         return False
 
+@lru_cache(maxsize=1)
 def get_git_version_info():
-    """Get version information from Git repository."""
+    """Get version information from Git repository (cached per process)."""
+    # Production images may ship without git; don't spawn commands bound to fail
+    if GIT_EXECUTABLE is None:
+        return None
     working_dir = get_working_directory()
     
     try:
-        # Check if we're in a git repository
-        if not run_git_command("git rev-parse --git-dir", working_dir):
+        # Get commit hash (short), date, ref names and message (first line only)
+        # in one call; this also fails outside a git repository
+        commit_info = run_git_command(GIT_COMMIT_INFO_CMD, working_dir)
+        if not commit_info:
             return None
+        commit_hash, commit_date, ref_names, commit_message = commit_info.split("\x1f", 3)
         
-        # IMPORTANT: Configure Git settings FIRST, before any checks
-        # This prevents false dirty flags due to file mode changes during Docker build
-        run_git_command("git config core.filemode false", working_dir)
-        run_git_command("git config core.autocrlf false", working_dir)
-        run_git_command("git config core.safecrlf false", working_dir)
-        
-        # Try to refresh the index to avoid stale state issues
-        run_git_command("git update-index --refresh", working_dir)
-
-        # Get commit hash (short)
-        commit_hash = run_git_command("git rev-parse --short HEAD", working_dir)
-        
-        # Get commit date
-        commit_date = run_git_command("git log -1 --format=%ci", working_dir)
-        
-        # Get commit message (first line only)
-        commit_message = run_git_command("git log -1 --format=%s", working_dir)
-        
-        # Get branch name
-        branch = run_git_command("git rev-parse --abbrev-ref HEAD", working_dir)
-        
-        # Get tag if exists
-        tag = run_git_command("git describe --tags --exact-match HEAD", working_dir) or \
-              run_git_command("git describe --tags --abbrev=0", working_dir)
-        
-        # Check for uncommitted changes using enhanced method
-        has_changes = check_git_dirty_status(working_dir)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Check for uncommitted changes using enhanced method, in parallel
+            # with the tag lookup below (the two git processes are independent)
+            dirty_future = executor.submit(check_git_dirty_status, working_dir)
+            
+            # Get branch name and a tag pointing at HEAD from the ref names,
+            # e.g. "HEAD -> main, tag: v1.2, origin/main"
+            branch = "HEAD"  # Detached HEAD, as 'git rev-parse --abbrev-ref HEAD' reports it
+            tags = []
+            for ref in ref_names.split(", ") if ref_names else ():
+                if ref.startswith("HEAD -> "):
+                    branch = ref[len("HEAD -> "):]
+                elif ref.startswith("tag: "):
+                    tags.append(ref[len("tag: "):])
+            
+            if len(tags) == 1:
+                tag = tags[0]
+            elif tags:
+                # Let git pick among several tags (it prefers annotated ones)
+                tag = run_git_command(GIT_EXACT_TAG_CMD, working_dir) or tags[0]
+            else:
+                # Otherwise use the most recent tag, if any
+                tag = run_git_command(GIT_LATEST_TAG_CMD, working_dir)
+            
+            has_changes = dirty_future.result()
         dirty_suffix = "+dirty" if has_changes else ""
         
         if commit_hash and commit_date:
@@ -198,12 +243,13 @@ def get_git_version_info():
 def load_version_from_file(filepath):
     """Load version information from JSON file."""
     try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r') as f:
-                data = json.load(f)
-                # Add source indicator
-                data["source"] = "file"
-                return data
+        with open(filepath, 'rb') as f:
+            data = json_loads(f.read())
+        # Add source indicator
+        data["source"] = "file"
+        return data
+    except FileNotFoundError:
+        pass
     except (json.JSONDecodeError, IOError) as e:
         logger.warning(f"Could not load version from {filepath}: {e}")
     return None
@@ -216,16 +262,70 @@ def save_version_to_file(version_info, filepath):
         if directory:  # Only create if there's a directory component
             os.makedirs(directory, exist_ok=True)
         
-        with open(filepath, 'w') as f:
-            json.dump(version_info, f, indent=2)
+        with open(filepath, 'wb') as f:
+            f.write(json_dumps(version_info, indent=True))
         logger.info(f"Version info saved to {filepath}")
         return True
     except IOError as e:
         logger.error(f"Could not save version to {filepath}: {e}")
         return False
 
+def get_git_cache_key(working_dir):
+    """
+    Build the on-disk Git cache key from the modification times of .git/HEAD,
+    .git/index, .git/logs/HEAD (the reflog, which moves on every commit),
+    .git/packed-refs and .git/refs/tags (which change when tags are added).
+    Edits to tracked files change none of these, so the key does not cover
+    the dirty state. Returns None when none of them exist.
+    """
+    git_dir = os.path.join(working_dir, ".git")
+    key = []
+    for name in ("HEAD", "index", os.path.join("logs", "HEAD"), "packed-refs",
+                 os.path.join("refs", "tags")):
+        try:
+            key.append(os.stat(os.path.join(git_dir, name)).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return key if any(mtime is not None for mtime in key) else None
+
+def load_git_cache(filepath, cache_key):
+    """Load cached Git version information if it was saved under the same key."""
+    try:
+        with open(filepath, 'rb') as f:
+            data = json_loads(f.read())
+    except (json.JSONDecodeError, IOError):
+        return None
+    if data.pop("_cache_key", None) != cache_key:
+        return None
+    return data
+
+def save_git_cache(version_info, filepath, cache_key):
+    """Save Git version information together with its cache key."""
+    try:
+        with open(filepath, 'wb') as f:
+            f.write(json_dumps(dict(version_info, _cache_key=cache_key), indent=True))
+    except IOError as e:
+        logger.debug(f"Could not save git version cache to {filepath}: {e}")
+
+def prepare_git_repository(working_dir=None):
+    """
+    Configure Git and refresh the index before freezing a version.
+    This prevents false dirty flags due to file mode changes during Docker build.
+    Only run at build time: it writes .git/config and the index.
+    """
+    if GIT_EXECUTABLE is None:
+        return
+    if working_dir is None:
+        working_dir = get_working_directory()
+    for config_cmd in GIT_CONFIG_CMDS:
+        run_git_command(config_cmd, working_dir)
+    run_git_command(GIT_REFRESH_CMD, working_dir)
+
 def freeze_version(force_clean=False):
     """Freeze current version information to file."""
+    prepare_git_repository()
+    # Always freeze what Git reports right now, not a value cached earlier
+    get_git_version_info.cache_clear()
     version_info = get_git_version_info()
     
     # If Git is not available, create fallback version
@@ -251,21 +351,27 @@ def freeze_version(force_clean=False):
     # Get dynamic paths
     primary_path, fallback_path = get_version_file_paths()
     
-    # Try to save to primary location
-    if save_version_to_file(version_info, primary_path):
-        return version_info
-    # Fallback to secondary location  
-    elif save_version_to_file(version_info, fallback_path):
+    # Try to save to primary location, then the secondary one
+    saved = save_version_to_file(version_info, primary_path) or \
+            save_version_to_file(version_info, fallback_path)
+    
+    # Drop cached lookups, so the frozen file is picked up on the next call
+    get_git_version_info.cache_clear()
+    get_version_info.cache_clear()
+    
+    if saved:
         return version_info
     
     logger.error("Failed to save version to any location")
     return None
 
+@lru_cache(maxsize=1)
 def get_version_info():
     """
-    Get version information with fallback strategy:
+    Get version information with fallback strategy (cached per process):
     1. Try to load from frozen file
-    2. Fallback to Git repository
+    2. Fallback to Git repository (a clean tree's result is cached on disk
+       until HEAD, the index or the tags change; the dirty check always runs)
     3. Fallback to default version
     """
     # Get dynamic paths
@@ -281,9 +387,23 @@ def get_version_info():
     if version_info:
         return version_info
     
-    # Try to get from Git directly
+    # Try to get from Git directly, reusing the result cached by an earlier
+    # process while HEAD, the index, the reflog and the tags are unchanged.
+    # Only clean trees are cached: the key cannot see edits to tracked files,
+    # so a dirty tree always takes the full lookup.
+    working_dir = get_working_directory()
+    cache_path = os.path.join(working_dir, ".git", GIT_CACHE_FILE)
+    cache_key = get_git_cache_key(working_dir)
+    if cache_key:
+        version_info = load_git_cache(cache_path, cache_key)
+        if version_info and not check_git_dirty_status(working_dir):
+            return version_info
+    
     version_info = get_git_version_info()
     if version_info:
+        if (cache_key and not version_info["version_string"].endswith("+dirty")
+                and os.path.isdir(os.path.dirname(cache_path))):
+            save_git_cache(version_info, cache_path, cache_key)
         return version_info
     
     # Final fallback - static version
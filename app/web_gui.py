@@ -10,10 +10,13 @@ Description: A web interface for managing UPS Server configuration with unified
 import os
 import sys
 import subprocess
+import io
 import ipaddress
 import json
 import smtplib
 import re
+import socket
+from concurrent.futures import ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.utils import formataddr
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
@@ -23,6 +26,9 @@ from werkzeug.exceptions import BadRequest
 # Add the current directory to Python path to import modules
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from api import API_TOKEN, get_ups_name, get_server_ip
+from common import (WOL_DEFAULT_BROADCAST, WOL_PORT, build_magic_packet,
+                    cache_power_manager_config, config_lock, invalidate_power_manager_config,
+                    load_power_manager_config, write_file_atomic)
 
 # Import version information
 try:
@@ -60,122 +66,132 @@ def get_client_statuses():
         return {}
 
 def read_power_manager_config():
-    """Read and parse power_manager.conf file to get main config, wake hosts, and schedules."""
-    config = {}
-    wake_hosts = {}
-    schedules = {}
-    current_section = None
+    """Read and parse power_manager.conf file to get main config, wake hosts, and schedules.
+
+    Uses the same cached parser as power_manager.py; callers get their own
+    copies since the save handlers edit them.
+    """
+    return load_power_manager_config(POWER_MANAGER_CONFIG)
+
+
+def write_power_manager_config(config, wake_hosts, schedules):
+    """Write power_manager.conf file, preserving comments and structure is hard, so we rewrite.
+
+    The file is replaced atomically, so power_manager.py and the API, which
+    read it without the lock, never parse a half-written config. Callers hold
+    config_lock() from the read_power_manager_config() that produced the data
+    until this returns, so a change power_manager.py makes in between is not
+    overwritten (the lock is not re-entrant, so it is not taken here).
+    """
+    # Build the whole file in memory, then replace the config in one step
+    f = io.StringIO()
+    f.write("# === CONFIGURATION FILE FOR POWER_MANAGER.SH ===\n\n")
     
-    if not os.path.exists(POWER_MANAGER_CONFIG):
-        return config, wake_hosts, schedules
+    # Main config keys order
+    main_keys = [
+        'SENTINEL_HOSTS', 'WOL_DELAY_MINUTES', 'CLIENT_STALE_TIMEOUT_MINUTES',
+        'UPS_STATE_FILE', 'DEFAULT_BROADCAST_IP', 'API_TOKEN', 'POWER_SIMULATION_MODE', 'DEBUG_MODE'
+    ]
     
-    with open(POWER_MANAGER_CONFIG, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            
-            # Check for section headers
-            if line.startswith('[') and line.endswith(']'):
-                current_section = line[1:-1]
-                if current_section.startswith('WAKE_HOST_'):
-                    wake_hosts[current_section] = {}
-                elif current_section.startswith('SCHEDULE_'):
-                    schedules[current_section] = {}
-                else:
-                    # Reset if it's not a known section type, allowing for future sections
-                    current_section = None 
-                continue
-            
-            # Parse key=value pairs
-            if '=' in line:
-                key, value = line.split('=', 1)
-                key = key.strip()
-                # Remove quotes from values if present, strip whitespace again
-                value = value.strip().strip('"\'').strip()
-
-                if current_section:
-                    if current_section.startswith('WAKE_HOST_'):
-                        wake_hosts[current_section][key] = value
-                    elif current_section.startswith('SCHEDULE_'):
-                        schedules[current_section][key] = value
-                else:
-                    # This is a main config parameter
-                    config[key] = value
+    # Write main configuration
+    for key in main_keys:
+        if key in config:
+             f.write(f"{key}=\"{config[key]}\"\n")
+    
+    f.write("\n# === SMTP NOTIFICATIONS ===\n")
+    smtp_keys = [
+        'SMTP_SERVER', 'SMTP_PORT', 'SMTP_USE_TLS', 'SMTP_USER', 'SMTP_PASSWORD',
+        'SMTP_SENDER_NAME', 'SMTP_SENDER_EMAIL', 'SMTP_RECIPIENTS'
+    ]
+    for key in smtp_keys:
+        if key in config and config[key]:
+            f.write(f"{key}=\"{config[key]}\"\n")
+
+    f.write("\n# === NOTIFICATION SETTINGS ===\n")
+    notify_keys = [
+        'NOTIFY_POWER_FAIL', 'NOTIFY_POWER_RESTORED', 'NOTIFY_CLIENT_SHUTDOWN',
+        'NOTIFY_CLIENT_STALE', 'NOTIFY_APP_ERROR', 'NOTIFY_SIMULATION_MODE'
+    ]
+    for key in notify_keys:
+        if key in config:
+            f.write(f"{key}=\"{config[key]}\"\n")
+    # Optional per-type debounce overrides (DEBOUNCE_<TYPE>_SECONDS) are hand-edited
+    for key in sorted(k for k in config if k.startswith('DEBOUNCE_')):
+        f.write(f"{key}=\"{config[key]}\"\n")
+
+
+    f.write("\n# === WAKE-ON-LAN HOST DEFINITIONS ===\n")
     
-    return config, wake_hosts, schedules
+    # Write wake hosts
+    for section in sorted(wake_hosts.keys()):
+        f.write(f"\n[{section}]\n")
+        for key, value in wake_hosts[section].items():
+            f.write(f"{key}=\"{value}\"\n")
 
+    f.write("\n# === POWER OUTAGE SIMULATION SCHEDULES ===\n")
+    
+    # Write schedules
+    for section in sorted(schedules.keys()):
+        f.write(f"\n[{section}]\n")
+        for key, value in schedules[section].items():
+            f.write(f"{key}=\"{value}\"\n")
 
-def write_power_manager_config(config, wake_hosts, schedules):
-    """Write power_manager.conf file, preserving comments and structure is hard, so we rewrite."""
-    with open(POWER_MANAGER_CONFIG, 'w') as f:
-        f.write("# === CONFIGURATION FILE FOR POWER_MANAGER.SH ===\n\n")
-        
-        # Main config keys order
-        main_keys = [
-            'SENTINEL_HOSTS', 'WOL_DELAY_MINUTES', 'CLIENT_STALE_TIMEOUT_MINUTES',
-            'UPS_STATE_FILE', 'DEFAULT_BROADCAST_IP', 'API_TOKEN', 'POWER_SIMULATION_MODE', 'DEBUG_MODE'
-        ]
-        
-        # Write main configuration
-        for key in main_keys:
-            if key in config:
-                 f.write(f"{key}=\"{config[key]}\"\n")
-        
-        f.write("\n# === SMTP NOTIFICATIONS ===\n")
-        smtp_keys = [
-            'SMTP_SERVER', 'SMTP_PORT', 'SMTP_USE_TLS', 'SMTP_USER', 'SMTP_PASSWORD',
-            'SMTP_SENDER_NAME', 'SMTP_SENDER_EMAIL', 'SMTP_RECIPIENTS'
-        ]
-        for key in smtp_keys:
-            if key in config and config[key]:
-                f.write(f"{key}=\"{config[key]}\"\n")
-
-        f.write("\n# === NOTIFICATION SETTINGS ===\n")
-        notify_keys = [
-            'NOTIFY_POWER_FAIL', 'NOTIFY_POWER_RESTORED', 'NOTIFY_CLIENT_SHUTDOWN',
-            'NOTIFY_CLIENT_STALE', 'NOTIFY_APP_ERROR', 'NOTIFY_SIMULATION_MODE'
-        ]
-        for key in notify_keys:
-            if key in config:
-                f.write(f"{key}=\"{config[key]}\"\n")
-
-
-        f.write("\n# === WAKE-ON-LAN HOST DEFINITIONS ===\n")
-        
-        # Write wake hosts
-        for section in sorted(wake_hosts.keys()):
-            f.write(f"\n[{section}]\n")
-            for key, value in wake_hosts[section].items():
-                f.write(f"{key}=\"{value}\"\n")
-
-        f.write("\n# === POWER OUTAGE SIMULATION SCHEDULES ===\n")
-        
-        # Write schedules
-        for section in sorted(schedules.keys()):
-            f.write(f"\n[{section}]\n")
-            for key, value in schedules[section].items():
-                f.write(f"{key}=\"{value}\"\n")
+    content = f.getvalue().encode('utf-8')
+    try:
+        new_st = write_file_atomic(POWER_MANAGER_CONFIG, content)
+    except IOError:
+        invalidate_power_manager_config()
+        raise
+    # The next read in this worker uses what was just written
+    cache_power_manager_config(POWER_MANAGER_CONFIG, content, new_st)
 
 def ping_host(ip):
     """Check if host is online"""
     try:
         result = subprocess.run(
             [PING_CMD, "-c", "1", "-W", "1", ip],
-            capture_output=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
             timeout=2
         )
         return result.returncode == 0
     except:
         return False
 
+def ping_hosts(ips):
+    """Check several hosts at once; returns {ip: online}.
+
+    Each ping waits up to a second for a reply, so the hosts are pinged in
+    parallel rather than one after another.
+    """
+    ips = list(dict.fromkeys(ips))
+    if not ips:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(32, len(ips))) as executor:
+        return dict(zip(ips, executor.map(ping_host, ips)))
+
 def send_wol(mac, broadcast_ip):
-    """Send Wake-on-LAN packet"""
+    """Send Wake-on-LAN packet
+
+    The magic packet (6 x 0xFF, then the MAC 16 times) is sent directly over
+    UDP; a MAC in a format this cannot parse is left to the wakeonlan tool.
+    """
+    try:
+        packet = build_magic_packet(mac)
+    except ValueError:
+        try:
+            subprocess.run([WAKEONLAN_CMD, "-i", broadcast_ip, mac], 
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+            return True
+        except:
+            return False
+
     try:
-        subprocess.run([WAKEONLAN_CMD, "-i", broadcast_ip, mac], 
-                      capture_output=True, check=True)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            sock.sendto(packet, (broadcast_ip or WOL_DEFAULT_BROADCAST, WOL_PORT))
         return True
-    except:
+    except OSError:
         return False
 
 def send_email(subject, body, config):
@@ -305,18 +321,22 @@ def index():
                 clean_host = host.strip().strip('"').strip("'")
                 if clean_host and validate_ip(clean_host):
                     sentinel_hosts.append(clean_host)
-                    sentinel_status[clean_host] = ping_host(clean_host)
+                    sentinel_status[clean_host] = None  # Pinged below
                 elif clean_host:
                     # Invalid IP but not empty - still add for display but mark as offline
                     sentinel_hosts.append(clean_host)
                     sentinel_status[clean_host] = False
         
+        # Ping the valid sentinel hosts and all wake hosts in one parallel batch
+        wake_host_ips = {section: params.get('IP', '') for section, params in wake_hosts.items()}
+        online = ping_hosts([host for host, status in sentinel_status.items() if status is None] +
+                            [ip for ip in wake_host_ips.values() if ip])
+        for host, status in sentinel_status.items():
+            if status is None:
+                sentinel_status[host] = online[host]
+
         # Get wake host status
-        wake_host_status = {}
-        for section, params in wake_hosts.items():
-            ip = params.get('IP', '')
-            if ip:
-                wake_host_status[section] = ping_host(ip)
+        wake_host_status = {section: online[ip] for section, ip in wake_host_ips.items() if ip}
         
         # Get client statuses
         client_statuses = get_client_statuses()
@@ -367,60 +387,61 @@ def version_endpoint():
 def save_main_config():
     """Save main and SMTP power manager configuration"""
     try:
-        pm_config, wake_hosts, schedules = read_power_manager_config()
-        
-        # --- Update main config ---
-        pm_config['SENTINEL_HOSTS'] = request.form.get('sentinel_hosts', '')
-        pm_config['WOL_DELAY_MINUTES'] = request.form.get('wol_delay_minutes', '5')
-        pm_config['CLIENT_STALE_TIMEOUT_MINUTES'] = request.form.get('client_stale_timeout_minutes', '5')
-        pm_config['DEFAULT_BROADCAST_IP'] = request.form.get('default_broadcast_ip', '192.168.1.255')
-        pm_config['POWER_SIMULATION_MODE'] = 'true' if 'power_simulation_mode' in request.form else 'false'
-        pm_config['DEBUG_MODE'] = 'true' if 'debug_mode' in request.form else 'false'
-        if 'UPS_STATE_FILE' not in pm_config:
-            pm_config['UPS_STATE_FILE'] = request.form.get('ups_state_file', '/var/run/nut/virtual.device')
-
-        # --- Update SMTP config ---
-        pm_config['SMTP_SERVER'] = request.form.get('smtp_server', '')
-        pm_config['SMTP_PORT'] = request.form.get('smtp_port', '')
-        pm_config['SMTP_USER'] = request.form.get('smtp_user', '')
-        pm_config['SMTP_PASSWORD'] = request.form.get('smtp_password', '')
-        pm_config['SMTP_SENDER_NAME'] = request.form.get('smtp_sender_name', '')
-        pm_config['SMTP_SENDER_EMAIL'] = request.form.get('smtp_sender_email', '')
-        pm_config['SMTP_RECIPIENTS'] = request.form.get('smtp_recipients', '')
-        pm_config['SMTP_USE_TLS'] = request.form.get('smtp_use_tls', 'auto')  # New field
-
-        # --- Update Notification settings ---
-        notify_keys = [
-            'notify_power_fail', 'notify_power_restored', 'notify_client_shutdown',
-            'notify_client_stale', 'notify_app_error', 'notify_simulation_mode'
-        ]
-        for key in notify_keys:
-            # Convert to uppercase for the config file
-            config_key = key.upper() 
-            pm_config[config_key] = 'true' if key in request.form else 'false'
-
-        # --- Validation ---
-        sentinel_ips = pm_config['SENTINEL_HOSTS'].split()
-        for ip in sentinel_ips:
-            if ip and not validate_ip(ip):
-                flash(f'Invalid IP address in Sentinel Hosts: {ip}', 'error')
+        with config_lock():
+            pm_config, wake_hosts, schedules = read_power_manager_config()
+        
+            # --- Update main config ---
+            pm_config['SENTINEL_HOSTS'] = request.form.get('sentinel_hosts', '')
+            pm_config['WOL_DELAY_MINUTES'] = request.form.get('wol_delay_minutes', '5')
+            pm_config['CLIENT_STALE_TIMEOUT_MINUTES'] = request.form.get('client_stale_timeout_minutes', '5')
+            pm_config['DEFAULT_BROADCAST_IP'] = request.form.get('default_broadcast_ip', '192.168.1.255')
+            pm_config['POWER_SIMULATION_MODE'] = 'true' if 'power_simulation_mode' in request.form else 'false'
+            pm_config['DEBUG_MODE'] = 'true' if 'debug_mode' in request.form else 'false'
+            if 'UPS_STATE_FILE' not in pm_config:
+                pm_config['UPS_STATE_FILE'] = request.form.get('ups_state_file', '/var/run/nut/virtual.device')
+
+            # --- Update SMTP config ---
+            pm_config['SMTP_SERVER'] = request.form.get('smtp_server', '')
+            pm_config['SMTP_PORT'] = request.form.get('smtp_port', '')
+            pm_config['SMTP_USER'] = request.form.get('smtp_user', '')
+            pm_config['SMTP_PASSWORD'] = request.form.get('smtp_password', '')
+            pm_config['SMTP_SENDER_NAME'] = request.form.get('smtp_sender_name', '')
+            pm_config['SMTP_SENDER_EMAIL'] = request.form.get('smtp_sender_email', '')
+            pm_config['SMTP_RECIPIENTS'] = request.form.get('smtp_recipients', '')
+            pm_config['SMTP_USE_TLS'] = request.form.get('smtp_use_tls', 'auto')  # New field
+
+            # --- Update Notification settings ---
+            notify_keys = [
+                'notify_power_fail', 'notify_power_restored', 'notify_client_shutdown',
+                'notify_client_stale', 'notify_app_error', 'notify_simulation_mode'
+            ]
+            for key in notify_keys:
+                # Convert to uppercase for the config file
+                config_key = key.upper() 
+                pm_config[config_key] = 'true' if key in request.form else 'false'
+
+            # --- Validation ---
+            sentinel_ips = pm_config['SENTINEL_HOSTS'].split()
+            for ip in sentinel_ips:
+                if ip and not validate_ip(ip):
+                    flash(f'Invalid IP address in Sentinel Hosts: {ip}', 'error')
+                    return redirect(url_for('config'))
+        
+            if not validate_ip(pm_config['DEFAULT_BROADCAST_IP']):
+                flash('Invalid Default Broadcast IP address', 'error')
                 return redirect(url_for('config'))
-        
-        if not validate_ip(pm_config['DEFAULT_BROADCAST_IP']):
-            flash('Invalid Default Broadcast IP address', 'error')
-            return redirect(url_for('config'))
 
-        if pm_config.get('SMTP_RECIPIENTS') and not validate_email_list(pm_config['SMTP_RECIPIENTS']):
-             flash('Invalid email address format in Recipients field.', 'error')
-             return redirect(url_for('config'))
+            if pm_config.get('SMTP_RECIPIENTS') and not validate_email_list(pm_config['SMTP_RECIPIENTS']):
+                 flash('Invalid email address format in Recipients field.', 'error')
+                 return redirect(url_for('config'))
         
-        if pm_config.get('SMTP_SENDER_EMAIL') and not validate_email_list(pm_config['SMTP_SENDER_EMAIL']):
-             flash('Invalid email address format in Sender Email field.', 'error')
-             return redirect(url_for('config'))
+            if pm_config.get('SMTP_SENDER_EMAIL') and not validate_email_list(pm_config['SMTP_SENDER_EMAIL']):
+                 flash('Invalid email address format in Sender Email field.', 'error')
+                 return redirect(url_for('config'))
 
-        # --- Write the combined configuration ---
-        write_power_manager_config(pm_config, wake_hosts, schedules)
-        flash('Configuration saved successfully!', 'success')
+            # --- Write the combined configuration ---
+            write_power_manager_config(pm_config, wake_hosts, schedules)
+            flash('Configuration saved successfully!', 'success')
         
     except Exception as e:
         flash(f'Error saving configuration: {str(e)}', 'error')
@@ -455,44 +476,45 @@ def test_smtp():
 def add_wake_host():
     """Add new wake host"""
     try:
-        pm_config, wake_hosts, schedules = read_power_manager_config()
-
-        # Find next available wake host number
-        existing_numbers = [int(s.replace('WAKE_HOST_', '')) for s in wake_hosts.keys() if s.startswith('WAKE_HOST_')]
-        next_num = max(existing_numbers) + 1 if existing_numbers else 1
-        section_name = f"WAKE_HOST_{next_num}"
-
-        # Get form data and validate
-        name = request.form.get('name', '').strip()
-        ip = request.form.get('ip', '').strip()
-        mac = request.form.get('mac', '').strip()
-        broadcast_ip = request.form.get('broadcast_ip', '').strip()
-        shutdown_delay = request.form.get('shutdown_delay', '').strip()
-        auto_wol = 'true' if 'auto_wol' in request.form else 'false'
-        ignore_simulation = 'true' if 'ignore_simulation' in request.form else 'false'
-        
-        if not all([name, ip, mac]):
-            flash('Name, IP, and MAC address are required', 'error')
-            return redirect(url_for('config'))
-        if not validate_ip(ip):
-            flash(f'Invalid IP address: {ip}', 'error')
-            return redirect(url_for('config'))
-        if not validate_mac(mac):
-            flash(f'Invalid MAC address: {mac}', 'error')
-            return redirect(url_for('config'))
-        if broadcast_ip and not validate_ip(broadcast_ip):
-            flash(f'Invalid broadcast IP address: {broadcast_ip}', 'error')
-            return redirect(url_for('config'))
-        
-        # Add new wake host
-        wake_hosts[section_name] = {'NAME': name, 'IP': ip, 'MAC': mac, 'AUTO_WOL': auto_wol, 'IGNORE_SIMULATION': ignore_simulation}
-        if broadcast_ip:
-            wake_hosts[section_name]['BROADCAST_IP'] = broadcast_ip
-        if shutdown_delay:
-            wake_hosts[section_name]['SHUTDOWN_DELAY_MINUTES'] = shutdown_delay
-        
-        write_power_manager_config(pm_config, wake_hosts, schedules)
-        flash(f'Host "{name}" added successfully!', 'success')
+        with config_lock():
+            pm_config, wake_hosts, schedules = read_power_manager_config()
+
+            # Find next available wake host number
+            existing_numbers = [int(s.replace('WAKE_HOST_', '')) for s in wake_hosts.keys() if s.startswith('WAKE_HOST_')]
+            next_num = max(existing_numbers) + 1 if existing_numbers else 1
+            section_name = f"WAKE_HOST_{next_num}"
+
+            # Get form data and validate
+            name = request.form.get('name', '').strip()
+            ip = request.form.get('ip', '').strip()
+            mac = request.form.get('mac', '').strip()
+            broadcast_ip = request.form.get('broadcast_ip', '').strip()
+            shutdown_delay = request.form.get('shutdown_delay', '').strip()
+            auto_wol = 'true' if 'auto_wol' in request.form else 'false'
+            ignore_simulation = 'true' if 'ignore_simulation' in request.form else 'false'
+        
+            if not all([name, ip, mac]):
+                flash('Name, IP, and MAC address are required', 'error')
+                return redirect(url_for('config'))
+            if not validate_ip(ip):
+                flash(f'Invalid IP address: {ip}', 'error')
+                return redirect(url_for('config'))
+            if not validate_mac(mac):
+                flash(f'Invalid MAC address: {mac}', 'error')
+                return redirect(url_for('config'))
+            if broadcast_ip and not validate_ip(broadcast_ip):
+                flash(f'Invalid broadcast IP address: {broadcast_ip}', 'error')
+                return redirect(url_for('config'))
+        
+            # Add new wake host
+            wake_hosts[section_name] = {'NAME': name, 'IP': ip, 'MAC': mac, 'AUTO_WOL': auto_wol, 'IGNORE_SIMULATION': ignore_simulation}
+            if broadcast_ip:
+                wake_hosts[section_name]['BROADCAST_IP'] = broadcast_ip
+            if shutdown_delay:
+                wake_hosts[section_name]['SHUTDOWN_DELAY_MINUTES'] = shutdown_delay
+        
+            write_power_manager_config(pm_config, wake_hosts, schedules)
+            flash(f'Host "{name}" added successfully!', 'success')
         
     except Exception as e:
         flash(f'Error adding host: {str(e)}', 'error')
@@ -503,53 +525,54 @@ def add_wake_host():
 def edit_wake_host(section):
     """Edit existing wake host"""
     try:
-        pm_config, wake_hosts, schedules = read_power_manager_config()
+        with config_lock():
+            pm_config, wake_hosts, schedules = read_power_manager_config()
         
-        if section not in wake_hosts:
-            flash('Host not found', 'error')
-            return redirect(url_for('config'))
-        
-        # Get form data and validate
-        name = request.form.get('name', '').strip()
-        ip = request.form.get('ip', '').strip()
-        mac = request.form.get('mac', '').strip()
-        broadcast_ip = request.form.get('broadcast_ip', '').strip()
-        shutdown_delay = request.form.get('shutdown_delay', '').strip()
-        auto_wol = 'true' if 'auto_wol' in request.form else 'false'
-        ignore_simulation = 'true' if 'ignore_simulation' in request.form else 'false'
-
-        if not all([name, ip, mac]):
-            flash('Name, IP, and MAC address are required.', 'error')
-            return redirect(url_for('config'))
-        if not validate_ip(ip):
-            flash(f'Invalid IP address: {ip}', 'error')
-            return redirect(url_for('config'))
-        if not validate_mac(mac):
-            flash(f'Invalid MAC address: {mac}', 'error')
-            return redirect(url_for('config'))
-        if broadcast_ip and not validate_ip(broadcast_ip):
-            flash(f'Invalid broadcast IP address: {broadcast_ip}', 'error')
-            return redirect(url_for('config'))
-        
-        # Update wake host data
-        wake_hosts[section]['NAME'] = name
-        wake_hosts[section]['IP'] = ip
-        wake_hosts[section]['MAC'] = mac
-        wake_hosts[section]['AUTO_WOL'] = auto_wol
-        wake_hosts[section]['IGNORE_SIMULATION'] = ignore_simulation
-        
-        if broadcast_ip:
-            wake_hosts[section]['BROADCAST_IP'] = broadcast_ip
-        elif 'BROADCAST_IP' in wake_hosts[section]:
-            del wake_hosts[section]['BROADCAST_IP']
-
-        if shutdown_delay:
-            wake_hosts[section]['SHUTDOWN_DELAY_MINUTES'] = shutdown_delay
-        elif 'SHUTDOWN_DELAY_MINUTES' in wake_hosts[section]:
-            del wake_hosts[section]['SHUTDOWN_DELAY_MINUTES']
-        
-        write_power_manager_config(pm_config, wake_hosts, schedules)
-        flash(f'Host "{name}" updated successfully!', 'success')
+            if section not in wake_hosts:
+                flash('Host not found', 'error')
+                return redirect(url_for('config'))
+        
+            # Get form data and validate
+            name = request.form.get('name', '').strip()
+            ip = request.form.get('ip', '').strip()
+            mac = request.form.get('mac', '').strip()
+            broadcast_ip = request.form.get('broadcast_ip', '').strip()
+            shutdown_delay = request.form.get('shutdown_delay', '').strip()
+            auto_wol = 'true' if 'auto_wol' in request.form else 'false'
+            ignore_simulation = 'true' if 'ignore_simulation' in request.form else 'false'
+
+            if not all([name, ip, mac]):
+                flash('Name, IP, and MAC address are required.', 'error')
+                return redirect(url_for('config'))
+            if not validate_ip(ip):
+                flash(f'Invalid IP address: {ip}', 'error')
+                return redirect(url_for('config'))
+            if not validate_mac(mac):
+                flash(f'Invalid MAC address: {mac}', 'error')
+                return redirect(url_for('config'))
+            if broadcast_ip and not validate_ip(broadcast_ip):
+                flash(f'Invalid broadcast IP address: {broadcast_ip}', 'error')
+                return redirect(url_for('config'))
+        
+            # Update wake host data
+            wake_hosts[section]['NAME'] = name
+            wake_hosts[section]['IP'] = ip
+            wake_hosts[section]['MAC'] = mac
+            wake_hosts[section]['AUTO_WOL'] = auto_wol
+            wake_hosts[section]['IGNORE_SIMULATION'] = ignore_simulation
+        
+            if broadcast_ip:
+                wake_hosts[section]['BROADCAST_IP'] = broadcast_ip
+            elif 'BROADCAST_IP' in wake_hosts[section]:
+                del wake_hosts[section]['BROADCAST_IP']
+
+            if shutdown_delay:
+                wake_hosts[section]['SHUTDOWN_DELAY_MINUTES'] = shutdown_delay
+            elif 'SHUTDOWN_DELAY_MINUTES' in wake_hosts[section]:
+                del wake_hosts[section]['SHUTDOWN_DELAY_MINUTES']
+        
+            write_power_manager_config(pm_config, wake_hosts, schedules)
+            flash(f'Host "{name}" updated successfully!', 'success')
         
     except Exception as e:
         flash(f'Error updating host: {str(e)}', 'error')
@@ -560,15 +583,16 @@ def edit_wake_host(section):
 def delete_wake_host(section):
     """Delete wake host"""
     try:
-        pm_config, wake_hosts, schedules = read_power_manager_config()
+        with config_lock():
+            pm_config, wake_hosts, schedules = read_power_manager_config()
         
-        if section in wake_hosts:
-            name = wake_hosts[section].get('NAME', section)
-            del wake_hosts[section]
-            write_power_manager_config(pm_config, wake_hosts, schedules)
-            flash(f'Host "{name}" deleted successfully!', 'success')
-        else:
-            flash('Host not found', 'error')
+            if section in wake_hosts:
+                name = wake_hosts[section].get('NAME', section)
+                del wake_hosts[section]
+                write_power_manager_config(pm_config, wake_hosts, schedules)
+                flash(f'Host "{name}" deleted successfully!', 'success')
+            else:
+                flash('Host not found', 'error')
         
     except Exception as e:
         flash(f'Error deleting host: {str(e)}', 'error')
@@ -579,28 +603,29 @@ def delete_wake_host(section):
 def add_schedule():
     """Add a new schedule entry."""
     try:
-        pm_config, wake_hosts, schedules = read_power_manager_config()
-        
-        existing_numbers = [int(s.replace('SCHEDULE_', '')) for s in schedules.keys() if s.startswith('SCHEDULE_')]
-        next_num = max(existing_numbers) + 1 if existing_numbers else 1
-        section_name = f"SCHEDULE_{next_num}"
-        
-        new_schedule = {
-            'NAME': request.form.get('name'),
-            'TYPE': request.form.get('type'),
-            'TIME': request.form.get('time'),
-            'ACTION': request.form.get('action'),
-            'ENABLED': 'true' if 'enabled' in request.form else 'false'
-        }
+        with config_lock():
+            pm_config, wake_hosts, schedules = read_power_manager_config()
+        
+            existing_numbers = [int(s.replace('SCHEDULE_', '')) for s in schedules.keys() if s.startswith('SCHEDULE_')]
+            next_num = max(existing_numbers) + 1 if existing_numbers else 1
+            section_name = f"SCHEDULE_{next_num}"
+        
+            new_schedule = {
+                'NAME': request.form.get('name'),
+                'TYPE': request.form.get('type'),
+                'TIME': request.form.get('time'),
+                'ACTION': request.form.get('action'),
+                'ENABLED': 'true' if 'enabled' in request.form else 'false'
+            }
         
-        if new_schedule['TYPE'] == 'one-time':
-            new_schedule['DATE'] = request.form.get('date')
-        else:
-            new_schedule['DAY_OF_WEEK'] = request.form.get('day_of_week')
+            if new_schedule['TYPE'] == 'one-time':
+                new_schedule['DATE'] = request.form.get('date')
+            else:
+                new_schedule['DAY_OF_WEEK'] = request.form.get('day_of_week')
         
-        schedules[section_name] = new_schedule
-        write_power_manager_config(pm_config, wake_hosts, schedules)
-        flash(f'Schedule "{new_schedule["NAME"]}" added successfully!', 'success')
+            schedules[section_name] = new_schedule
+            write_power_manager_config(pm_config, wake_hosts, schedules)
+            flash(f'Schedule "{new_schedule["NAME"]}" added successfully!', 'success')
 
     except Exception as e:
         flash(f'Error adding schedule: {str(e)}', 'error')
@@ -611,31 +636,32 @@ def add_schedule():
 def edit_schedule(section):
     """Edit an existing schedule entry."""
     try:
-        pm_config, wake_hosts, schedules = read_power_manager_config()
-        if section not in schedules:
-            flash('Schedule not found', 'error')
-            return redirect(url_for('config'))
+        with config_lock():
+            pm_config, wake_hosts, schedules = read_power_manager_config()
+            if section not in schedules:
+                flash('Schedule not found', 'error')
+                return redirect(url_for('config'))
             
-        updated_schedule = {
-            'NAME': request.form.get('name'),
-            'TYPE': request.form.get('type'),
-            'TIME': request.form.get('time'),
-            'ACTION': request.form.get('action'),
-            'ENABLED': 'true' if 'enabled' in request.form else 'false'
-        }
+            updated_schedule = {
+                'NAME': request.form.get('name'),
+                'TYPE': request.form.get('type'),
+                'TIME': request.form.get('time'),
+                'ACTION': request.form.get('action'),
+                'ENABLED': 'true' if 'enabled' in request.form else 'false'
+            }
 
-        # Clear old type-specific fields before updating
-        schedules[section].pop('DATE', None)
-        schedules[section].pop('DAY_OF_WEEK', None)
+            # Clear old type-specific fields before updating
+            schedules[section].pop('DATE', None)
+            schedules[section].pop('DAY_OF_WEEK', None)
 
-        if updated_schedule['TYPE'] == 'one-time':
-            updated_schedule['DATE'] = request.form.get('date')
-        else:
-            updated_schedule['DAY_OF_WEEK'] = request.form.get('day_of_week')
+            if updated_schedule['TYPE'] == 'one-time':
+                updated_schedule['DATE'] = request.form.get('date')
+            else:
+                updated_schedule['DAY_OF_WEEK'] = request.form.get('day_of_week')
 
-        schedules[section].update(updated_schedule)
-        write_power_manager_config(pm_config, wake_hosts, schedules)
-        flash(f'Schedule "{updated_schedule["NAME"]}" updated successfully!', 'success')
+            schedules[section].update(updated_schedule)
+            write_power_manager_config(pm_config, wake_hosts, schedules)
+            flash(f'Schedule "{updated_schedule["NAME"]}" updated successfully!', 'success')
         
     except Exception as e:
         flash(f'Error updating schedule: {str(e)}', 'error')
@@ -646,14 +672,15 @@ def edit_schedule(section):
 def delete_schedule(section):
     """Delete a schedule entry."""
     try:
-        pm_config, wake_hosts, schedules = read_power_manager_config()
-        if section in schedules:
-            name = schedules[section].get('NAME', section)
-            del schedules[section]
-            write_power_manager_config(pm_config, wake_hosts, schedules)
-            flash(f'Schedule "{name}" deleted successfully!', 'success')
-        else:
-            flash('Schedule not found', 'error')
+        with config_lock():
+            pm_config, wake_hosts, schedules = read_power_manager_config()
+            if section in schedules:
+                name = schedules[section].get('NAME', section)
+                del schedules[section]
+                write_power_manager_config(pm_config, wake_hosts, schedules)
+                flash(f'Schedule "{name}" deleted successfully!', 'success')
+            else:
+                flash('Schedule not found', 'error')
     
     except Exception as e:
         flash(f'Error deleting schedule: {str(e)}', 'error')
@@ -693,19 +720,20 @@ def get_status():
         
         # Check sentinel hosts
         sentinel_hosts = pm_config.get('SENTINEL_HOSTS', '').split()
-        sentinel_status = {}
+        clean_hosts = []
         for host in sentinel_hosts:
             if host:
                 clean_host = host.strip().strip('"').strip("'")
                 if clean_host:
-                    sentinel_status[clean_host] = ping_host(clean_host)
+                    clean_hosts.append(clean_host)
+        wake_host_ips = {section: params.get('IP', '') for section, params in wake_hosts.items()}
+
+        # Ping sentinel and wake hosts in one parallel batch
+        online = ping_hosts(clean_hosts + [ip for ip in wake_host_ips.values() if ip])
+        sentinel_status = {host: online[host] for host in clean_hosts}
         
         # Check wake hosts
-        wake_host_status = {}
-        for section, params in wake_hosts.items():
-            ip = params.get('IP', '')
-            if ip:
-                wake_host_status[section] = ping_host(ip)
+        wake_host_status = {section: online[ip] for section, ip in wake_host_ips.items() if ip}
         
         return jsonify({
             'sentinel_status': sentinel_status,
@@ -82,4 +82,4 @@ gunicorn --workers 2 --bind 0.0.0.0:80 --chdir /app web_gui:app --daemon
 
 # --- 5. Start the UPS Hub API ---
 echo "Starting Gunicorn for UPS Hub API on port 5000..."
-exec gunicorn --workers 3 --bind 0.0.0.0:5000 --chdir /app api:app
\ No newline at end of file
+exec gunicorn -c /app/gunicorn_api.conf.py api:app
\ No newline at end of file